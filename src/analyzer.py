@@ -1,26 +1,56 @@
 import json
 import mido
-import numpy as np
 from libs.pymidifile import (
     reformat_midi,
     mid_to_matrix,
     matrix_to_mid,
     quantize_matrix,
+    mid_to_notes,
+    quantize_notes,
+    notes_to_onset_ticks,
 )
+from alignment import edit_distance_table, trace_alignment, classify_differences, OnlineAlignment
 
 
 class Analyzer:
-    def __init__(self, judgement_level="beginner"):
+
+    # notes this close together (in beats) are treated as played at the same time
+    chord_window_beats = 0.5
+    # a missing note and an extra note of the same pitch this close together (in beats)
+    # are one note played at the wrong time
+    shift_window_beats = 2
+    # resolution of the note times that are compared (same as matrix_to_mid)
+    ticks_per_beat = 96
+    # quantization grid for each judgement level (see quantize_matrix)
+    quantize_grids = {
+        "beginner": {"stepSize": 0.25},
+        "intermediate": {"stepSize": 0.125},
+    }
+
+    def __init__(self, judgement_level="beginner", alignment_band=None, song_cache=None):
         self.judgement_level = judgement_level
-        pass
+        # optional Sakoe-Chiba band (in notes) for the alignment, None for the full table
+        self.alignment_band = alignment_band
+        # optional SongCache for references given as file paths
+        self.song_cache = song_cache
 
     # is user input good enough
 
-    def judge_attempt(self, reference_midi, user_midi):
+    def judge_attempt(self, reference_midi, user_midi, verified_notes=0):
 
         # compare the files
-        errors = self.midi_compare(reference_midi, user_midi)
+        errors = self.midi_compare(reference_midi, user_midi, verified_notes)
+
+        return self.judge_errors(errors)
+
+    # grade an attempt while it is being played
+
+    def start_attempt(self, reference_midi, on_mistake=None, verified_notes=0, reference_notes=None):
+        return LiveAttempt(
+            self, reference_midi, on_mistake=on_mistake, verified_notes=verified_notes, reference_notes=reference_notes
+        )
 
+    def judge_errors(self, errors):
         sufficient = True
         match self.judgement_level:
             case "beginner":
@@ -86,10 +116,24 @@ class Analyzer:
 
     # find all the mistakes
 
-    def midi_compare(self, reference_file, user_file):
-        reference_midi = self.quantize_midi(reference_file)
-        user_midi = self.quantize_midi(user_file)
+    def midi_compare(self, reference_file, user_file, verified_notes=0):
+        ref_pitches, ref_times = self.note_times(self.note_array(reference_file))
+        user_pitches, user_times = self.note_times(self.note_array(user_file))
+
+        return self.compare_notes(
+            ref_pitches,
+            ref_times,
+            user_pitches,
+            user_times,
+            self.ticks_per_beat,
+            verified_notes=verified_notes,
+        )
+
+    # `verified_notes` leading reference notes were approved before (a checkpoint):
+    # if the user played them note for note, only the notes after them are aligned,
+    # and a given `dp` is the table for those notes only (see verified_prefix)
 
+    def compare_notes(self, ref_pitches, ref_times, user_pitches, user_times, ticks_per_beat, dp=None, verified_notes=0):
         errors = {
             "incorrect_pitches": [],
             "timing_issues": [],
@@ -97,216 +141,44 @@ class Analyzer:
             "extra_notes": [],
         }
 
-        ref_ticks = 0
-        user_ticks = 0
-
-        ref_track = reference_midi.merged_track
-        user_track = user_midi.merged_track
-
-        self.convert_timing_to_absolute(ref_track)
-        self.convert_timing_to_absolute(user_track)
-
-        ref_notes = []
-        user_notes = []
-
-        for msg in ref_track:
-            if msg.type == "note_on":
-                ref_notes.append((msg.note, msg.time))
-
-        for msg in user_track:
-            if msg.type == "note_on":
-                user_notes.append((msg.note, msg.time))
+        verified = self.verified_prefix(ref_pitches, user_pitches, verified_notes)
 
         # Dynamic programming to find optimal alignment
-        dp = np.zeros((len(ref_notes) + 1, len(user_notes) + 1))
-        for i in range(len(ref_notes) + 1):
-            for j in range(len(user_notes) + 1):
-                if i == 0 or j == 0:
-                    dp[i][j] = i + j
-                elif ref_notes[i - 1][0] == user_notes[j - 1][0]:
-                    dp[i][j] = dp[i - 1][j - 1]
-                else:
-                    dp[i][j] = 1 + min(dp[i - 1][j], dp[i]
-                                       [j - 1], dp[i - 1][j - 1])
+        if dp is None:
+            dp = edit_distance_table(
+                ref_pitches[verified:],
+                user_pitches[verified:],
+                band=self.alignment_band,
+                ref_times=ref_times[verified:],
+                user_times=user_times[verified:],
+            )
 
         # Traceback to find alignment and report errors
-        i = len(ref_notes)
-        j = len(user_notes)
-
-        incorrect_pitches = []
-
-        while i > 0 or j > 0:
-            if i > 0 and j > 0 and ref_notes[i - 1][0] == user_notes[j - 1][0]:
-
-                # check for timing issues (notes are played too far from the reference)
-                if (
-                    abs(ref_notes[i - 1][1] - user_notes[j - 1][1]) > 10
-                ):  # TODO: find a good threshold
-
-                    # if, in the reference, there are two notes of the same pitch played in a row
-                    if i > 1 and ref_notes[i - 1][0] == ref_notes[i - 2][0]:
-
-                        # check if the user got the other note right (if not, it's a timing issue)
-                        if j > 1 and user_notes[j - 2][0] == ref_notes[i - 2][0]:
-                            i -= 1
-                            j -= 1
-                            continue
-
-                        errors["timing_issues"].append(
-                            {
-                                "reference_pitch": ref_notes[i - 1][0],
-                                "reference_time": ref_notes[i - 1][1],
-                                "time": user_notes[j - 1][1],
-                            }
-                        )
-
-                # No error, move to previous notes
-                i -= 1
-                j -= 1
-            else:
+        errors["timing_issues"], incorrect_pitches = trace_alignment(
+            dp, ref_pitches, user_pitches, ref_times, user_times, verified=verified
+        )
 
-                # Check for missing or extra notes
-                if i > 0 and (j == 0 or dp[i][j - 1] >= dp[i - 1][j]):
-                    incorrect_pitches.append(
-                        {
-                            "reference_pitch": ref_notes[i - 1][0],
-                            "user_pitch": None,
-                            "time": sum([msg[1] for msg in ref_notes[:i]]),
-                        }
-                    )
-                    i -= 1
-                elif j > 0 and (i == 0 or dp[i][j - 1] < dp[i - 1][j]):
-                    incorrect_pitches.append(
-                        {
-                            "reference_pitch": None,
-                            "user_pitch": user_notes[j - 1][0],
-                            "time": sum([msg[1] for msg in user_notes[:j]]),
-                        }
-                    )
-                    j -= 1
+        # the tolerance windows, in ticks of the quantized reference
+        chord_window = self.chord_window_beats * ticks_per_beat
+        shift_window = self.shift_window_beats * ticks_per_beat
 
         # now that we have the incorrect pitches, we can figure out the type of error
         # and add it to the errors dictionary
-        while len(incorrect_pitches) > 0:
-            pitch = incorrect_pitches[0]
-
-            # if the user played a pitch that was not in the reference
-            if pitch["reference_pitch"] is None:
-
-                # see if the user played a different pitch at the same time
-                also_played = []
-                for j in range(1, len(incorrect_pitches)):
-                    other_pitch = incorrect_pitches[j]
-                    if (
-                        abs(other_pitch["time"] - pitch["time"]) < 1000
-                        and other_pitch["reference_pitch"] is not None
-                    ):
-                        also_played.append(
-                            (
-                                other_pitch,
-                                abs(
-                                    other_pitch["reference_pitch"] -
-                                    pitch["user_pitch"]
-                                ),
-                            )
-                        )
-
-                # if the user played a different pitch at the same time
-                if len(also_played) > 0:
-                    # find the closest pitch
-                    closest_pitch = min(also_played, key=lambda x: x[1])
-                    if closest_pitch[0]["reference_pitch"] != pitch["user_pitch"]:
-                        errors["incorrect_pitches"].append(
-                            {
-                                "reference_pitch": closest_pitch[0]["reference_pitch"],
-                                "user_pitch": pitch["user_pitch"],
-                                "time": pitch["time"],
-                            }
-                        )
-                    # remove the closest pitch from the list
-                    incorrect_pitches.remove(closest_pitch[0])
-                    incorrect_pitches.pop(0)
-
-                # if we didn't find a matching pitch, then the user played an extra note
-                else:
-                    errors["extra_notes"].append(
-                        {"user_pitch": pitch["user_pitch"],
-                            "time": pitch["time"]}
-                    )
-                    incorrect_pitches.pop(0)
-
-            # if the user missed a pitch that was in the reference
-            elif pitch["user_pitch"] is None:
-
-                # if the user played a different pitch at the same time
-                also_played = []
-                for j in range(1, len(incorrect_pitches)):
-                    other_pitch = incorrect_pitches[j]
-                    if (
-                        abs(other_pitch["time"] - pitch["time"]) < 1000
-                        and other_pitch["user_pitch"] is not None
-                    ):
-                        also_played.append(
-                            (
-                                other_pitch,
-                                abs(
-                                    other_pitch["user_pitch"] -
-                                    pitch["reference_pitch"]
-                                ),
-                            )
-                        )
-
-                # if the user played a different pitch at the same time
-                if len(also_played) > 0:
-                    # find the closest pitch
-                    closest_pitch = min(also_played, key=lambda x: x[1])
-                    if closest_pitch[0]["user_pitch"] != pitch["reference_pitch"]:
-                        errors["incorrect_pitches"].append(
-                            {
-                                "reference_pitch": pitch["reference_pitch"],
-                                "user_pitch": closest_pitch[0]["user_pitch"],
-                                "time": pitch["time"],
-                            }
-                        )
-                    # remove the closest pitch from the list
-                    incorrect_pitches.remove(closest_pitch[0])
-                    incorrect_pitches.pop(0)
-
-                # if we didn't find a matching pitch, then the user missed a note
-                else:
-                    errors["missing_notes"].append(
-                        {
-                            "reference_pitch": pitch["reference_pitch"],
-                            "time": pitch["time"],
-                        }
-                    )
-                    incorrect_pitches.pop(0)
-
-        # look through missing/extra notes to see if they were just played at the wrong time
-        i = 0
-        while i < len(errors["missing_notes"]):
-            missing_note = errors["missing_notes"][i]
-            for j in range(len(errors["extra_notes"])):
-                extra_note = errors["extra_notes"][j]
-                if (
-                    abs(missing_note["time"] - extra_note["time"]) < 3000
-                    and missing_note["reference_pitch"] == extra_note["user_pitch"]
-                ):
-                    errors["timing_issues"].append(
-                        {
-                            "reference_pitch": missing_note["reference_pitch"],
-                            "reference_time": missing_note["time"],
-                            "time": extra_note["time"],
-                        }
-                    )
-                    errors["missing_notes"].pop(i)
-                    errors["extra_notes"].pop(j)
-                    i -= 1
-                    break
-            i += 1
+        classified = classify_differences(incorrect_pitches, chord_window, shift_window)
+        errors["incorrect_pitches"] = classified["incorrect_pitches"]
+        errors["missing_notes"] = classified["missing_notes"]
+        errors["extra_notes"] = classified["extra_notes"]
+        errors["timing_issues"] += classified["timing_issues"]
 
         return errors
 
+    def verified_prefix(self, ref_pitches, user_pitches, verified_notes):
+        # the checkpoint holds only if the user replayed the verified notes exactly
+        verified_notes = min(verified_notes, len(ref_pitches))
+        if verified_notes > 0 and list(user_pitches[:verified_notes]) == list(ref_pitches[:verified_notes]):
+            return verified_notes
+        return 0
+
     def clean_midi(self, mid):
         return reformat_midi(
             mid, verbose=False, write_to_file=False, override_time_info=True
@@ -322,6 +194,34 @@ class Analyzer:
         )
         return matrix_to_mid(quantizer)
 
+    # same notes as quantize_midi, as a note array, without building any MidiFile
+
+    def note_array(self, mid):
+        if self.song_cache is not None and isinstance(mid, str):
+            return self.song_cache.quantized_notes(mid, self.quantize_grid())
+
+        notes = mid_to_notes(mid, override_time_info=True)
+        return quantize_notes(
+            notes, quantizeOffsets=True, quantizeDurations=False, **self.quantize_grid()
+        )
+
+    # pitches and absolute onset ticks of a note array, as midi_compare compares them
+
+    def note_times(self, notes):
+        pitches, ticks = notes_to_onset_ticks(notes, self.ticks_per_beat)
+        # measured from the first note (the first message of a track starts at 0)
+        if len(ticks) > 0:
+            ticks = ticks - ticks[0]
+        return pitches.tolist(), ticks.tolist()
+
+    def quantize_onset(self, onset):
+        return quantize_matrix(
+            [[0, onset, 0]], quantizeOffsets=True, quantizeDurations=False, **self.quantize_grid()
+        )[0][1]
+
+    def quantize_grid(self):
+        return self.quantize_grids.get(self.judgement_level, self.quantize_grids["beginner"])
+
     def convert_timing_to_absolute(self, track):
         time = 0
         track[0].time = 0
@@ -335,6 +235,188 @@ class Analyzer:
         return round(num / step) * step
 
 
+class LiveAttempt:
+    """
+    Grade an attempt note by note while the student is playing it.
+
+    Feed it the note events as they are recorded (see Player.record_attempt).
+    Every note_on is aligned against the reference right away and likely
+    mistakes are reported through `on_mistake`; the final verdict is worked
+    out as soon as the last note_off of the snippet comes in.
+
+    The first `verified_notes` notes of the snippet may have been approved
+    already. As long as the student replays them note for note they are only
+    checked off, and the alignment covers the notes after them; a deviation
+    inside them falls back to aligning the whole snippet.
+    """
+
+    def __init__(
+        self, analyzer: Analyzer, reference_midi: mido.MidiFile, on_mistake=None, verified_notes=0, reference_notes=None
+    ) -> None:
+        """
+        Args:
+            analyzer (Analyzer): The analyzer whose settings are used to judge the attempt
+            reference_midi (mido.MidiFile): The snippet the student is playing
+            on_mistake (callable): Called with (error_type, error) for every mistake as it is played
+            verified_notes (int): Number of leading notes of the snippet that were approved before
+            reference_notes (NoteMatrix): The snippet's notes already quantized (see SongCache.quantized_snippets),
+                None to quantize them from `reference_midi`
+
+        Returns:
+            None
+        """
+        self.analyzer = analyzer
+        self.on_mistake = on_mistake
+        self.resolution = reference_midi.ticks_per_beat
+
+        # the student is done with the snippet once every reference note has been released
+        self.total_notes = 0
+        for track in reference_midi.tracks:
+            for msg in track:
+                if msg.type == "note_off":
+                    self.total_notes += 1
+
+        if reference_notes is None:
+            reference_notes = analyzer.note_array(reference_midi)
+        # the same pitches and times as midi_compare compares
+        self.ref_pitches, self.ref_times = analyzer.note_times(reference_notes)
+
+        # the alignment starts after the verified notes, until the student deviates in them
+        self.checkpoint = verified_notes
+        self.verified_notes = min(verified_notes, len(self.ref_pitches))
+        self.alignment = OnlineAlignment(self.ref_pitches[self.verified_notes:])
+        self.user_pitches = []
+        self.user_times = []
+        self.first_onset = None
+        self.elapsed = 0
+        self.notes_off = 0
+        self.result = None
+
+        # the attempt as Player.record_attempt records it, to judge it the same way at the end
+        self.recording = mido.MidiFile(ticks_per_beat=self.resolution)
+        self.track = mido.MidiTrack()
+        self.recording.tracks.append(self.track)
+
+    def note_on(self, note: int, delta_ticks: int) -> list:
+        """
+        Take the next key press and report the mistakes it reveals.
+
+        Args:
+            note (int): Midi note number
+            delta_ticks (int): Ticks since the previous event, in the reference's resolution
+
+        Returns:
+            list: (error_type, error) tuples, in the format of the analyzer's errors dict
+        """
+        self.elapsed += delta_ticks
+        self.track.append(mido.Message("note_on", note=note, velocity=64, time=delta_ticks))
+
+        # measured from the first note, like the reference (see Analyzer.note_times)
+        onset = self.analyzer.quantize_onset(self.elapsed / self.resolution) * self.analyzer.ticks_per_beat
+        if self.first_onset is None:
+            self.first_onset = onset
+        time = onset - self.first_onset
+
+        self.user_pitches.append(note)
+        self.user_times.append(time)
+
+        mistakes = []
+        for move, i in self.align(note):
+            if move == "substitute":
+                mistakes.append(("incorrect_pitches", {
+                    "reference_pitch": self.ref_pitches[i],
+                    "user_pitch": note,
+                    "time": time,
+                }))
+            elif move == "insert":
+                mistakes.append(("extra_notes", {"user_pitch": note, "time": time}))
+            elif move == "delete":
+                mistakes.append(("missing_notes", {
+                    "reference_pitch": self.ref_pitches[i],
+                    "time": self.ref_times[i],
+                }))
+
+        if self.on_mistake is not None:
+            for error_type, error in mistakes:
+                self.on_mistake(error_type, error)
+
+        return mistakes
+
+    def align(self, note: int) -> list:
+        """
+        Push the latest user note to the alignment.
+
+        Args:
+            note (int): Midi note number, already added to user_pitches
+
+        Returns:
+            list: The edit moves (see OnlineAlignment.push), with indexes into the whole reference
+        """
+        j = len(self.user_pitches) - 1
+
+        if j < self.verified_notes:
+            if note == self.ref_pitches[j]:
+                return [("match", j)]
+
+            # a deviation inside the verified notes: align the whole snippet after all
+            self.verified_notes = 0
+            self.alignment = OnlineAlignment(self.ref_pitches)
+            for pitch in self.user_pitches[:-1]:
+                self.alignment.push(pitch)
+
+        offset = self.verified_notes
+        return [(move, i if i is None else i + offset) for move, i in self.alignment.push(note)]
+
+    def note_off(self, note: int, delta_ticks: int):
+        """
+        Take the next key release. The last one of the snippet settles the verdict.
+
+        Args:
+            note (int): Midi note number
+            delta_ticks (int): Ticks since the previous event, in the reference's resolution
+
+        Returns:
+            tuple: The verdict (see verdict) once the snippet is complete, None before that
+        """
+        self.elapsed += delta_ticks
+        self.track.append(mido.Message("note_off", note=note, velocity=0, time=delta_ticks))
+        self.notes_off += 1
+        if self.notes_off >= self.total_notes:
+            return self.verdict()
+        return None
+
+    def verdict(self):
+        """
+        Judge the attempt so far, the same way Analyzer.judge_attempt does.
+
+        Returns:
+            tuple: (is_sufficient, mistake_timeline)
+        """
+        if self.result is None or self.result[0] != len(self.track):
+            # the user's notes as judge_attempt reads them from the recording: their times
+            # depend on when the notes are released too
+            user_pitches, user_times = self.analyzer.note_times(self.analyzer.note_array(self.recording))
+
+            # the table built while the student played applies if the notes came in the same order,
+            # and once the verified notes have all been played
+            if user_pitches == self.user_pitches and len(user_pitches) >= self.verified_notes:
+                dp, verified_notes = self.alignment.table(), self.verified_notes
+            else:
+                dp, verified_notes = None, self.checkpoint
+
+            errors = self.analyzer.compare_notes(
+                self.ref_pitches,
+                self.ref_times,
+                user_pitches,
+                user_times,
+                self.analyzer.ticks_per_beat,
+                dp=dp,
+                verified_notes=verified_notes,
+            )
+            self.result = (len(self.track), self.analyzer.judge_errors(errors))
+        return self.result[1]
+
+
 if __name__ == "__main__":
     # Example usage
     analyzer = Analyzer()
@@ -0,0 +1,310 @@
+"""
+Micro-benchmarks for the note processing pipeline.
+
+Usage:
+    python benchmark.py pairing [--notes 100000]
+    python benchmark.py reformat [--notes 2000] [--tracks 8]
+    python benchmark.py imports [--repeat 5]
+    python benchmark.py events [--events 1000]
+    python benchmark.py alignment [--notes 2000] [--band 50] [--repeat 7]
+"""
+
+import random
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+from mido import MidiFile, MidiTrack, Message
+
+
+def synthetic_midi(n_notes: int, seed: int = 0, n_tracks: int = 1, zero_velocity_offs: bool = False) -> MidiFile:
+    """
+    Build a midi file with `n_notes` random, overlapping notes
+    (including overlapping notes of the same pitch).
+
+    With more than one track it is a type 1 file and the notes are dealt out
+    over the tracks. With `zero_velocity_offs` notes are released with
+    velocity 0 note_on messages instead of note_off messages.
+    """
+    rng = random.Random(seed)
+
+    events = [[] for _ in range(n_tracks)]
+    start = 0
+    for i in range(n_notes):
+        start += rng.choice([0, 0, 24, 48, 96])
+        pitch = rng.randint(48, 72)
+        events[i % n_tracks].append((start, 1, pitch))
+        events[i % n_tracks].append((start + rng.choice([24, 96, 384]), 0, pitch))
+
+    mid = MidiFile(type=0 if n_tracks == 1 else 1, ticks_per_beat=96)
+    for track_events in events:
+        track_events.sort(key=lambda event: (event[0], event[1]))
+        track = MidiTrack()
+        mid.tracks.append(track)
+        elapsed = 0
+        for time_, is_on, pitch in track_events:
+            msg_type = "note_on" if is_on or zero_velocity_offs else "note_off"
+            track.append(Message(msg_type, note=pitch, velocity=100 if is_on else 0, time=time_ - elapsed))
+            elapsed = time_
+    return mid
+
+
+def _pairing_before(mid: MidiFile) -> list:
+    # the pairing mid_to_matrix used before the per-(channel, pitch) queues
+    resolution = mid.ticks_per_beat
+    elapsed = 0
+    noteons = []
+    offsets = []
+    noteoffs = []
+    durations = []
+    for msg in mid.tracks[0]:
+        elapsed += msg.time
+        offset = elapsed / resolution
+        if msg.type == 'note_on':
+            noteons.append(msg.note)
+            offsets.append(offset)
+        if msg.type == 'note_off':
+            noteoffs.append(msg.note)
+            durations.append(offset)
+    mnotes = []
+    for i in range(len(noteons)):
+        mnotes.append(
+            [noteons[i], offsets[i], durations[noteoffs.index(noteons[i])] - offsets[i]])
+        durations.pop(noteoffs.index(noteons[i]))
+        noteoffs.remove(noteons[i])
+    return mnotes
+
+
+def bench_pairing(n_notes: int) -> None:
+    from libs.pymidifile import mid_to_matrix
+
+    mid = synthetic_midi(n_notes)
+    print(f"Pairing {n_notes} notes ({len(mid.tracks[0])} messages)")
+
+    start = time.perf_counter()
+    _pairing_before(mid)
+    before = time.perf_counter() - start
+    print(f"  list scans:         {before:.3f} s")
+
+    start = time.perf_counter()
+    mid_to_matrix(mid, output="note_matrix")
+    after = time.perf_counter() - start
+    print(f"  open-note queues:   {after:.3f} s")
+
+    print(f"  speedup:            {before / after:.1f}x")
+
+
+def _reformat_before(mid: MidiFile) -> MidiFile:
+    # the flattening and note_off replacement reformat_midi did before it merged the tracks by time
+    from mido import MetaMessage
+
+    excluded = {"sequence_number", "text", "copyright", "track_name", "instrument_name",
+                "lyrics", "marker", "cue_marker", "device_name", "channel_prefix",
+                "midi_port", "sequencer_specific", "end_of_track", "smpte_offset",
+                "time_signature", "set_tempo"}
+
+    flat_track = MidiTrack()
+    flat_track.append(MetaMessage("set_tempo", tempo=480000, time=0))
+    flat_track.append(MetaMessage("time_signature", numerator=4, denominator=4, time=0))
+    for track in mid.tracks:
+        for msg in track:
+            if not any(msg.type == msg_type for msg_type in excluded):
+                flat_track.append(msg)
+    mid.tracks.clear()
+    mid.type = 0
+    mid.tracks.append(flat_track)
+
+    for msg in mid.tracks[0]:
+        if msg.type == 'note_on' and msg.velocity == 0:
+            mid.tracks[0].insert(mid.tracks[0].index(msg),
+                                 Message('note_off', note=msg.note, velocity=msg.velocity, time=msg.time))
+            mid.tracks[0].remove(msg)
+
+    events = [msg for msg in mid.tracks[0] if msg.type == 'note_on' or msg.type == 'note_off']
+    if events and events[-1].type == 'note_on':
+        mid.tracks[0].append(Message('note_off', note=events[-1].note, velocity=0, time=0))
+    mid.tracks[0].append(MetaMessage('end_of_track', time=0))
+    return mid
+
+
+def bench_reformat(n_notes: int, n_tracks: int) -> None:
+    from libs.pymidifile import reformat_midi
+
+    mid = synthetic_midi(n_notes, n_tracks=n_tracks, zero_velocity_offs=True)
+    n_messages = sum(len(track) for track in mid.tracks)
+    print(f"Reformatting {n_notes} notes ({n_messages} messages in {n_tracks} tracks)")
+
+    # both reformat the file in place, so each gets its own copy
+    start = time.perf_counter()
+    _reformat_before(mid)
+    before = time.perf_counter() - start
+    print(f"  concatenate/replace: {before:.3f} s")
+
+    mid = synthetic_midi(n_notes, n_tracks=n_tracks, zero_velocity_offs=True)
+    start = time.perf_counter()
+    reformat_midi(mid, verbose=False, write_to_file=False)
+    after = time.perf_counter() - start
+    print(f"  merge/rebuild:       {after:.3f} s")
+
+    print(f"  speedup:             {before / after:.1f}x")
+
+
+# times the import in a fresh interpreter and reports which heavy modules it loaded
+_IMPORT_TIMER = """
+import sys, time
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(elapsed, *[name for name in ("music21", "pandas") if name in sys.modules])
+"""
+
+
+def _cold_import(statement: str, repeat: int) -> tuple:
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-W", "ignore", "-c", _IMPORT_TIMER.format(statement=statement)],
+            capture_output=True, text=True, check=True,
+        ).stdout.split()
+        times.append(float(output[0]))
+    return sorted(times)[len(times) // 2], output[1:]
+
+
+def bench_imports(repeat: int) -> None:
+    print(f"Cold-start import time (median of {repeat} fresh interpreters)")
+
+    # what `from analyzer import Analyzer` used to load: the package imported features_from_midi eagerly
+    before, loaded = _cold_import("from analyzer import Analyzer; import libs.pymidifile.features_from_midi", repeat)
+    print(f"  eager package:      {before:.3f} s  (loads {', '.join(loaded) or 'nothing heavy'})")
+
+    after, loaded = _cold_import("from analyzer import Analyzer", repeat)
+    print(f"  lazy package:       {after:.3f} s  (loads {', '.join(loaded) or 'nothing heavy'})")
+
+    print(f"  speedup:            {before / after:.1f}x")
+
+
+def _local_server():
+    # a keep-alive HTTP server that answers every request like the Flask routes do
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # headers and body go out as separate writes; do not hold the body back for an ack
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            body = b'{"message": "State set."}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_events(n_events: int) -> None:
+    import requests
+    from lesson_events import BackgroundEvents, HttpEvents, StoreEvents
+    from state_store import StateStore
+
+    server = _local_server()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    print(f"Sending {n_events} lesson events (time per event, as seen by the lesson)")
+
+    def per_event(send, flush=None) -> float:
+        start = time.perf_counter()
+        for i in range(n_events):
+            send("demoing" if i % 2 else "recording")
+        elapsed = time.perf_counter() - start
+        if flush is not None:
+            flush()
+        return elapsed / n_events
+
+    before = per_event(lambda state: requests.get(f"{base_url}/setState?state={state}"))
+    print(f"  new connection:     {before * 1e6:9.1f} us")
+
+    http = HttpEvents(base_url)
+    print(f"  pooled session:     {per_event(http.set_state) * 1e6:9.1f} us")
+
+    background = BackgroundEvents(HttpEvents(base_url))
+    print(f"  fire-and-forget:    {per_event(background.set_state, background.flush) * 1e6:9.1f} us")
+
+    store = StoreEvents(StateStore(None))
+    print(f"  in-process store:   {per_event(store.set_state) * 1e6:9.1f} us")
+
+    queued = BackgroundEvents(StoreEvents(StateStore(None)))
+    print(f"  in-process queue:   {per_event(queued.set_state, queued.flush) * 1e6:9.1f} us")
+
+    server.shutdown()
+
+
+def bench_alignment(n_notes: int, band: int, repeat: int) -> None:
+    import numpy as np
+    from alignment import edit_distance_table
+
+    # an attempt with one note in ten a semitone off
+    rng = np.random.default_rng(0)
+    ref = rng.integers(48, 72, n_notes)
+    user = ref.copy()
+    user[rng.random(n_notes) < 0.1] += 1
+    print(f"Edit-distance table of {n_notes} x {n_notes} notes (median of {repeat} runs)")
+
+    def median_time(band) -> float:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            edit_distance_table(ref, user, band=band)
+            times.append(time.perf_counter() - start)
+        return sorted(times)[len(times) // 2]
+
+    full = median_time(None)
+    print(f"  full table:         {full:.3f} s")
+
+    banded = median_time(band)
+    print(f"  {f'band of {band}:':<20}{banded:.3f} s")
+
+    print(f"  speedup:            {full / banded:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmarks for the note processing pipeline.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    pairing = subparsers.add_parser("pairing", help="note_on/note_off pairing in mid_to_matrix")
+    pairing.add_argument("--notes", type=int, default=100_000, help="Number of notes in the synthetic file.")
+
+    reformat = subparsers.add_parser("reformat", help="flattening a multi-track file with reformat_midi")
+    reformat.add_argument("--notes", type=int, default=2_000, help="Number of notes in the synthetic file.")
+    reformat.add_argument("--tracks", type=int, default=8, help="Number of tracks in the synthetic file.")
+
+    imports = subparsers.add_parser("imports", help="cold-start time of `from analyzer import Analyzer`")
+    imports.add_argument("--repeat", type=int, default=5, help="Number of fresh interpreters to time.")
+
+    events = subparsers.add_parser("events", help="sending lesson events to the server (see lesson_events)")
+    events.add_argument("--events", type=int, default=1000, help="Number of events to send.")
+
+    alignment = subparsers.add_parser("alignment", help="the banded edit-distance table against the full one")
+    alignment.add_argument("--notes", type=int, default=2000, help="Number of notes in each sequence.")
+    alignment.add_argument("--band", type=int, default=50, help="Band width, in notes.")
+    alignment.add_argument("--repeat", type=int, default=7, help="Number of runs to time.")
+
+    args = parser.parse_args()
+
+    if args.benchmark == "pairing":
+        bench_pairing(args.notes)
+    elif args.benchmark == "reformat":
+        bench_reformat(args.notes, args.tracks)
+    elif args.benchmark == "imports":
+        bench_imports(args.repeat)
+    elif args.benchmark == "events":
+        bench_events(args.events)
+    elif args.benchmark == "alignment":
+        bench_alignment(args.notes, args.band, args.repeat)
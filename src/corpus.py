@@ -0,0 +1,204 @@
+"""
+Memory-mapped store of the notes of every downloaded song.
+
+All songs' note arrays are packed one after the other into a single file of
+NOTE_DTYPE records (assets/corpus/notes.bin), which is memory-mapped: loading
+a song is a slice of that map, nothing is parsed or copied. A sidecar table
+(assets/corpus/songs.json) holds, per song, where its notes are and what it
+is like: title, note count, duration, pitch range and timing.
+
+Listing the library only reads the sidecar, so it costs the same for ten
+songs as for tens of thousands. Songs can be added from several threads at
+once (the server's requests): appending notes and rewriting the sidecar
+happen under one lock.
+"""
+
+import json
+import os
+import threading
+
+import mido
+import numpy as np
+
+from libs.pymidifile import NOTE_DTYPE, NoteMatrix, mid_to_notes, write_atomically
+from snippets import SongSnippets, song_timing
+
+
+class CorpusStore:
+
+    def __init__(self, directory: str = "../assets/corpus") -> None:
+        """
+        Args:
+            directory (str): Where the store's files are kept
+
+        Returns:
+            None
+        """
+        self.directory = directory
+        self.notes_path = os.path.join(directory, "notes.bin")
+        self.table_path = os.path.join(directory, "songs.json")
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.songs = {}
+        if os.path.exists(self.table_path):
+            with open(self.table_path) as f:
+                self.songs = {song["title"]: song for song in json.load(f)}
+
+        self._notes = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.songs)
+
+    def __contains__(self, title: str) -> bool:
+        return title in self.songs
+
+    def titles(self) -> list:
+        """
+        Returns:
+            list: The titles of all songs in the store
+        """
+        with self._lock:
+            return list(self.songs)
+
+    def metadata(self, title: str) -> dict:
+        """
+        Args:
+            title (str): Title of a song (its file name)
+
+        Returns:
+            dict: The song's row of the sidecar table
+        """
+        return self.songs[title]
+
+    def notes(self, title: str) -> NoteMatrix:
+        """
+        The notes of a song, as a read-only view on the memory-mapped store.
+
+        Args:
+            title (str): Title of a song (its file name)
+
+        Returns:
+            NoteMatrix: The song's notes, ordered by onset
+        """
+        with self._lock:
+            song = self.songs[title]
+            if self._notes is None or len(self._notes) < song["offset"] + song["notes"]:
+                self._notes = self._map()
+            notes = self._notes
+        return NoteMatrix(notes[song["offset"]:song["offset"] + song["notes"]])
+
+    def song_snippets(self, title: str) -> SongSnippets:
+        """
+        Args:
+            title (str): Title of a song (its file name)
+
+        Returns:
+            SongSnippets: The song's lesson snippets
+        """
+        song = self.songs[title]
+        return SongSnippets(
+            self.notes(title),
+            song["ticks_per_beat"],
+            tempo=song["tempo"],
+            beats_per_bar=song["beats_per_bar"],
+        )
+
+    def add(self, path: str, title: str = None) -> dict:
+        """
+        Add a song to the store, or replace it if the file has changed since it was added.
+
+        Args:
+            path (str): Path to a midi file
+            title (str): Title to store the song under, the file name by default
+
+        Returns:
+            dict: The song's row of the sidecar table
+        """
+        self._append([(path, title or os.path.basename(path))])
+        return self.songs[title or os.path.basename(path)]
+
+    def build(self, midi_directory: str) -> int:
+        """
+        Add every midi file of a directory that is new or has changed since it was added.
+
+        Args:
+            midi_directory (str): Directory with the midi files
+
+        Returns:
+            int: Number of songs added or replaced
+        """
+        files = []
+        with os.scandir(midi_directory) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.lower().endswith((".mid", ".midi")):
+                    files.append((entry.path, entry.name))
+        return self._append(files)
+
+    def _append(self, files: list) -> int:
+        # notes are only ever appended; a replaced song's old notes are left unused
+        # one writer at a time: each song's offset is where the file ends when it is written
+        with self._lock:
+            changed = 0
+            with open(self.notes_path, "ab") as notes_file:
+                offset = notes_file.tell() // NOTE_DTYPE.itemsize
+                for path, title in files:
+                    stat = os.stat(path)
+                    known = self.songs.get(title)
+                    if known is not None and known["size"] == stat.st_size and known["mtime"] == stat.st_mtime:
+                        continue
+
+                    try:
+                        mid = mido.MidiFile(path)
+                    except (OSError, ValueError, EOFError, KeyError) as e:
+                        print(f"Skipping {title}: {e}")
+                        continue
+                    notes = mid_to_notes(mid, override_time_info=True)
+                    if notes is None:
+                        continue
+                    notes = notes.sorted()
+                    tempo, beats_per_bar = song_timing(mid)
+
+                    notes_file.write(notes.notes.tobytes())
+                    self.songs[title] = {
+                        "title": title,
+                        "offset": offset,
+                        "notes": len(notes),
+                        "duration": float((notes["onset"] + notes["duration"]).max()) if len(notes) > 0 else 0.0,
+                        "lowest": int(notes["pitch"].min()) if len(notes) > 0 else None,
+                        "highest": int(notes["pitch"].max()) if len(notes) > 0 else None,
+                        "ticks_per_beat": mid.ticks_per_beat,
+                        "tempo": tempo,
+                        "beats_per_bar": beats_per_bar,
+                        "size": stat.st_size,
+                        "mtime": stat.st_mtime,
+                    }
+                    offset += len(notes)
+                    changed += 1
+
+            if changed:
+                self._write_table()
+            return changed
+
+    def _write_table(self) -> None:
+        # replace the sidecar at once, after the notes it points to are on disk (called under the lock)
+        write_atomically(self.table_path, json.dumps(list(self.songs.values())).encode())
+
+    def _map(self) -> np.ndarray:
+        if os.path.getsize(self.notes_path) == 0:
+            return np.zeros(0, dtype=NOTE_DTYPE)
+        return np.memmap(self.notes_path, dtype=NOTE_DTYPE, mode="r")
+
+
+if __name__ == "__main__":
+
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Pack a directory of midi files into the corpus store.")
+    parser.add_argument("input", nargs="?", default="../assets/midi/downloads", help="Directory with the midi files.")
+    parser.add_argument("-o", "--output", default="../assets/corpus", help="Directory of the corpus store.")
+
+    args = parser.parse_args()
+
+    corpus = CorpusStore(args.output)
+    print("Added or updated", corpus.build(args.input), "songs;", len(corpus), "songs in the store.")
@@ -0,0 +1,358 @@
+"""
+Feedback for the student, rephrased by a language model without making
+anyone wait for it.
+
+FeedbackService takes the instructor's advice and returns at once. The
+rephrased text is published to the state store when it is ready: straight
+away if the advice is one of the instructor's fixed messages (rephrased
+ahead of time, see PhrasingTable) or was rephrased recently (the answers are
+kept in an LRU cache whose entries expire), otherwise when the model
+answers. If the model is slow or fails, a rule-based rephrasing is
+published instead.
+
+The phrasing table is built once, before the server runs:
+
+    python feedback.py build [--variants 5]
+
+StubClient stands in for the OpenAI client, so all of this runs offline.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from libs.pymidifile import write_atomically
+from state_store import StateStore
+from ttl_cache import TTLCache
+
+
+# what the instructor says about each type of mistake: (one note, several notes)
+MISTAKE_MESSAGES = {
+    "wrong_notes": (
+        "Some of your notes are slightly off here. Try again and pay extra attention here.",
+        "Some of your notes are slightly off here. Try again and pay extra attention here.",
+    ),
+    "missing_notes": (
+        "You missed a note here. Try playing it again.",
+        "You missed some notes in this chord. Try playing them again.",
+    ),
+    "extra_notes": (
+        "You played an extra note here. Try playing it again.",
+        "You played some extra notes in this chord. Try playing it again.",
+    ),
+    "early_timing": (
+        "You played this note too early. Try playing it again.",
+        "You played these notes too early. Try playing them again.",
+    ),
+    "late_timing": (
+        "You played this note too late. Try playing it again.",
+        "You played these notes too late. Try playing them again.",
+    ),
+}
+OTHER_MISTAKE_MESSAGE = "There was a mistake here. Try playing this part again."
+
+
+def mistake_messages() -> list:
+    """
+    Returns:
+        list: Every message the instructor can give about a mistake, once each
+    """
+    messages = [message for pair in MISTAKE_MESSAGES.values() for message in pair]
+    return list(dict.fromkeys(messages + [OTHER_MISTAKE_MESSAGE]))
+
+
+def strip_time(advice: str) -> str:
+    """
+    Args:
+        advice (str): The instructor's advice, which may start with where the mistake is
+
+    Returns:
+        str: The advice without its "Time ...:" prefix
+    """
+    return re.sub(r"^Time [^:]*:\s*", "", advice)
+
+
+# (pattern in the advice, what a teacher would say instead)
+FALLBACK_RULES = [
+    (r"missed", "Nice effort! A note went missing there. Go back to that spot and make sure every note sounds."),
+    (r"extra notes?", "Good try! An extra note slipped in there. Play it again and keep to the written notes."),
+    (r"too early", "Close! You came in a little early there. Wait for the beat and try it again."),
+    (r"too late", "Close! You came in a little late there. Stay with the beat and try it again."),
+    (r"off", "Nearly there! Some notes were a little off. Take that spot slowly and try it again."),
+]
+
+
+def rule_based_feedback(advice: str) -> str:
+    """
+    Rephrase advice without a model, for when the model is slow or unavailable.
+
+    Args:
+        advice (str): The instructor's advice (see Instructor._describe_mistake)
+
+    Returns:
+        str: The advice, rephrased
+    """
+    message = strip_time(advice)
+    for pattern, feedback in FALLBACK_RULES:
+        if re.search(pattern, message, re.IGNORECASE):
+            return feedback
+    return "Good try! " + message
+
+
+class StubClient:
+    """
+    Offline stand-in for the OpenAI client: answers like the model would, after `delay` seconds.
+    """
+
+    def __init__(self, delay: float = 0.0) -> None:
+        """
+        Args:
+            delay (float): Seconds every answer takes
+
+        Returns:
+            None
+        """
+        self.delay = delay
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    openers = ["Here's a tip: ", "Nice try! ", "Almost there! ", "Keep going! ", "Good effort! "]
+
+    def create(self, model: str, messages: list, n: int = 1, **kwargs) -> SimpleNamespace:
+        self.calls += 1
+        time.sleep(self.delay)
+        return SimpleNamespace(choices=[
+            SimpleNamespace(message=SimpleNamespace(content=self.openers[i % len(self.openers)] + messages[-1]["content"]))
+            for i in range(n)
+        ])
+
+
+class PhrasingTable:
+    """
+    Rephrasings of the instructor's fixed messages (see MISTAKE_MESSAGES), made ahead of
+    time, so the usual feedback needs no call to the model. Each message has a few
+    rephrasings, which are given in turn.
+    """
+
+    def __init__(self, phrasings: dict = None) -> None:
+        """
+        Args:
+            phrasings (dict): Rephrasings, by message
+
+        Returns:
+            None
+        """
+        self.phrasings = phrasings or {}
+        self._turns = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str = "../assets/feedback_phrasings.json") -> "PhrasingTable":
+        """
+        Args:
+            path (str): Table written by build
+
+        Returns:
+            PhrasingTable: The table, empty if it has not been built
+        """
+        try:
+            with open(path) as f:
+                return cls(json.load(f))
+        except (OSError, ValueError):
+            print(f"No phrasing table at {path}, run `python feedback.py build` to make one.")
+            return cls()
+
+    @classmethod
+    def build(cls, client, path: str = "../assets/feedback_phrasings.json", variants: int = 5) -> "PhrasingTable":
+        """
+        Ask the model for rephrasings of every fixed message and save them.
+
+        Args:
+            client: OpenAI client (or StubClient)
+            path (str): Where to save the table
+            variants (int): Number of rephrasings asked for per message
+
+        Returns:
+            PhrasingTable: The new table
+        """
+        phrasings = {}
+        for message in mistake_messages():
+            response = client.chat.completions.create(
+                model=FeedbackService.model,
+                messages=[
+                    {"role": "system", "content": FeedbackService.system_prompt},
+                    {"role": "user", "content": message},
+                ],
+                n=variants,
+                temperature=1.0,
+            )
+            phrasings[message] = list(dict.fromkeys(choice.message.content for choice in response.choices))
+
+        write_atomically(path, json.dumps(phrasings, indent=1).encode())
+
+        return cls(phrasings)
+
+    def lookup(self, advice: str) -> str:
+        """
+        Args:
+            advice (str): The instructor's advice
+
+        Returns:
+            str: The next rephrasing of the advice, None if it is not one of the fixed messages
+        """
+        message = strip_time(advice)
+        variants = self.phrasings.get(message)
+        if not variants:
+            return None
+        with self._lock:
+            turn = self._turns.get(message, 0)
+            self._turns[message] = turn + 1
+        return variants[turn % len(variants)]
+
+    def __len__(self) -> int:
+        return len(self.phrasings)
+
+
+class FeedbackService:
+
+    model = "gpt-3.5-turbo"
+    system_prompt = (
+        "Act as though you are a piano teacher providing feedback to a student. Rephase the text given to you in "
+        "order to provide constructive feedback. Do not provide anything but what you would say to a student in "
+        "your response."
+    )
+
+    def __init__(
+        self,
+        client,
+        store: StateStore,
+        cache: TTLCache = None,
+        phrasings: PhrasingTable = None,
+        deadline: float = 3.0,
+        workers: int = 2,
+    ) -> None:
+        """
+        Args:
+            client: OpenAI client (or StubClient)
+            store (StateStore): Where the feedback is published
+            cache (TTLCache): Rephrasings by advice, a new cache by default
+            phrasings (PhrasingTable): Rephrasings of the fixed messages made ahead of time, None for none
+            deadline (float): Seconds to wait for the model before publishing the rule-based rephrasing
+            workers (int): Number of requests to the model that can run at once
+
+        Returns:
+            None
+        """
+        self.client = client
+        self.store = store
+        self.cache = cache if cache is not None else TTLCache()
+        self.phrasings = phrasings if phrasings is not None else PhrasingTable()
+        self.deadline = deadline
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="feedback")
+        self._lock = threading.Lock()
+        self._latest = 0
+        self._published = 0
+
+    def submit(self, advice: str) -> None:
+        """
+        Rephrase advice and publish it (the state becomes "feedback"), without waiting for the model.
+
+        Only the latest advice is published, and only while the lesson is still where it was when the
+        advice was given: a rephrasing that arrives after newer advice, or after the lesson has moved on
+        (to the next demo, say), is dropped.
+
+        Args:
+            advice (str): The instructor's advice
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._latest += 1
+            job = (self._latest, self.store.get("state"))
+
+        feedback = self.phrasings.lookup(advice)
+        if feedback is None:
+            feedback = self.cache.get(advice)
+        if feedback is not None:
+            self._publish(job, feedback)
+            return
+
+        fallback = threading.Timer(self.deadline, self._publish, (job, rule_based_feedback(advice)))
+        fallback.daemon = True
+        fallback.start()
+
+        answer = self._executor.submit(self.rephrase, advice)
+        answer.add_done_callback(lambda answer: self._answered(job, advice, answer, fallback))
+
+    def rephrase(self, advice: str) -> str:
+        """
+        Rephrase advice with the model, or take the rephrasing from the cache.
+
+        Args:
+            advice (str): The instructor's advice
+
+        Returns:
+            str: The advice, rephrased
+        """
+        feedback = self.cache.get(advice)
+        if feedback is None:
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": self.system_prompt},
+                    {"role": "user", "content": advice},
+                ],
+            )
+            feedback = response.choices[0].message.content
+            self.cache.put(advice, feedback)
+        return feedback
+
+    def _answered(self, job: tuple, advice: str, answer, fallback: threading.Timer) -> None:
+        fallback.cancel()
+        if answer.exception() is not None:
+            print(f"Could not rephrase feedback: {answer.exception()}")
+            self._publish(job, rule_based_feedback(advice))
+        else:
+            self._publish(job, answer.result())
+
+    def _publish(self, job: tuple, feedback: str) -> None:
+        # the first rephrasing of the latest advice wins, if the lesson has not moved on since
+        number, state = job
+        with self._lock:
+            if number != self._latest or number == self._published:
+                return
+            self._published = number
+            self.store.compare_and_set({"state": state}, feedback=feedback, state="feedback")
+
+
+if __name__ == "__main__":
+
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Rephrase the instructor's fixed messages ahead of time.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="build the phrasing table (with the model if OPENAI_API_KEY is set)")
+    build.add_argument("--variants", type=int, default=5, help="Number of rephrasings per message.")
+    build.add_argument("-o", "--output", default="../assets/feedback_phrasings.json", help="Where to save the table.")
+
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    if os.getenv("OPENAI_API_KEY"):
+        from openai import OpenAI
+        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    else:
+        print("OPENAI_API_KEY is not set, using the offline stub.")
+        client = StubClient()
+
+    table = PhrasingTable.build(client, args.output, variants=args.variants)
+    print(f"Saved {sum(len(variants) for variants in table.phrasings.values())} rephrasings "
+          f"of {len(table)} messages to {args.output}")
@@ -1,27 +1,44 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 
-from song_finder import SongFinder, get_search_results
-from instructor import Instructor
-from player import Player
-from analyzer import Analyzer
-import mido
+from song_finder import SongFinder, find_songs, get_song_index
+from corpus import CorpusStore
+from state_store import StateStore
+from feedback import FeedbackService, PhrasingTable, StubClient
 import os
 import json
 from openai import OpenAI
 from dotenv import load_dotenv
 load_dotenv()
 
-client = OpenAI(
-    api_key=os.getenv("OPENAI_API_KEY")
-)
+# without an API key, feedback is rephrased by an offline stand-in
+if os.getenv("OPENAI_API_KEY"):
+    client = OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY")
+    )
+else:
+    client = StubClient()
 app = Flask(__name__)
 CORS(app)
 
-# set the default values for the state
-if not os.path.exists('state.json'):
-    with open('state.json', 'w') as f:
-        json.dump({"state": "search", "feedback": "", "song": ""}, f)
+DOWNLOADS_DIR = '../assets/midi/downloads'
+
+# the downloaded songs, packed for listing and loading without parsing every file;
+# songs added to the downloads since the last start are packed now (unchanged ones only cost a stat)
+corpus = CorpusStore()
+corpus.build(DOWNLOADS_DIR)
+
+# searches for downloaded songs are answered from this index, without asking the song site;
+# it is built from the corpus store's notes, so the downloads are not parsed a second time
+song_index = get_song_index()
+song_index.build_from_corpus(corpus)
+
+# the lesson state, served from memory and saved to state.json in the background
+state_store = StateStore('state.json')
+
+# rephrases feedback in the background and publishes it to the state when it is ready;
+# the instructor's usual messages come from the phrasing table, without asking the model
+feedback_service = FeedbackService(client, state_store, phrasings=PhrasingTable.load())
 # else:
 #    with open('state.json', "r") as f:
 #        file = json.load(f)
@@ -36,14 +53,8 @@ if not os.path.exists('state.json'):
 @app.route('/teach', methods=['GET'])
 async def teach():
 
-    # if state is "song_set", then start the lesson
-    with open('state.json', 'r') as f:
-        file = json.load(f)
-    if file['state'] == "song_set":
-        # set the state to "lesson_started"
-        file['state'] = "lesson_started"
-        with open('state.json', 'w') as f:
-            json.dump(file, f)
+    # if state is "song_set", then start the lesson (set the state to "lesson_started")
+    if state_store.compare_and_set({"state": "song_set"}, state="lesson_started"):
         return jsonify({"message": "Lesson started."})
 
     # end the lesson
@@ -55,13 +66,7 @@ def setState():
     print("HSDFSDFSDF")
     state = request.args.get('state')
     print(state)
-    # write to json called state.json
-    with open('state.json', 'r') as f:
-        file = json.load(f)
-    file['state'] = state
-
-    with open('state.json', 'w') as f:
-        json.dump(file, f)
+    state_store.set(state=state)
 
     return jsonify({"message": "State set."})
 
@@ -69,51 +74,66 @@ def setState():
 @app.route('/setFeedback', methods=['GET'])
 def setFeedback():
     feedback = request.args.get('feedback')
-    # write to json called state.json
-    print(feedback)
-    # load gpt 3.0 model
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "Act as though you are a piano teacher providing feedback to a student. Rephase the text given to you in order to provide constructive feedback. Do not provide anything but what you would say to a student in your response."},
-            {"role": "user", "content": feedback}
-        ]
-    )
-    print(response)
-    feedback = response.choices[0].message.content
     print(feedback)
-    with open('state.json', 'r') as f:
-        file = json.load(f)
-        file['feedback'] = feedback
-        file['state'] = "feedback"
-
-    with open('state.json', 'w') as f:
-        json.dump(file, f)
+    # returns at once, the rephrased feedback is published when it is ready
+    feedback_service.submit(feedback)
 
     return jsonify({"message": "Feedback set."})
 
 
+@app.route('/setLiveMistake', methods=['GET'])
+def setLiveMistake():
+    # shown while the student is still playing, cleared when the next attempt starts
+    state_store.set(live_mistake=request.args.get('mistake', default=''))
+    return jsonify({"message": "Live mistake set."})
+
+
 @app.route('/getFeedback', methods=['GET'])
 def getFeedback():
-    if os.path.exists('state.json'):
-        with open('state.json') as f:
-            feedback = json.load(f)["feedback"]
-    return jsonify({"feedback": feedback})
+    return jsonify({"feedback": state_store.get("feedback")})
 
 
 @app.route('/getState', methods=['GET'])
 def getState():
-    if os.path.exists('state.json'):
-        with open('state.json') as f:
-            state = json.load(f)['state']
-    return jsonify({"state": state})
+    version, state = state_store.snapshot()
+    return jsonify({"state": state["state"], "version": version})
+
+
+@app.route('/waitState', methods=['GET'])
+def waitState():
+    # long poll: answer as soon as the state has changed since the version the client has seen
+    since = request.args.get('since', default=-1, type=int)
+    timeout = min(request.args.get('timeout', default=25, type=float), 60)
+    version, state = state_store.wait(since, timeout)
+    return jsonify(dict(state, version=version))
+
+
+@app.route('/events', methods=['GET'])
+def events():
+    # server-sent events: every change of the state (state, feedback, live mistake and song), as it happens
+    since = request.headers.get('Last-Event-ID', default=-1, type=int)
+
+    def stream(version):
+        while True:
+            new_version, state = state_store.wait(version, timeout=15)
+            if new_version == version:
+                # keeps the connection open through proxies
+                yield ": keep-alive\n\n"
+                continue
+            version = new_version
+            yield f"id: {version}\ndata: {json.dumps(state)}\n\n"
+
+    return Response(stream(since), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 
 @app.route('/search', methods=['GET'])
 def search():
-    search_query = request.args.get('query')
-    results_array = get_search_results(search_query)
-    return jsonify({"results": results_array})
+    search_query = request.args.get('query', default='')
+    # local results at once; with too few of them, the song site is searched in the background
+    # and "complete" is false until its results are in (wait=1 waits for them)
+    wait = request.args.get('wait', default=0, type=int)
+    results_array, complete = find_songs(search_query, wait=bool(wait))
+    return jsonify({"results": results_array, "complete": complete})
 
 
 @app.route('/setSong', methods=['GET'])
@@ -121,44 +141,35 @@ def setSong():
     song_url = request.args.get('song_url')
     song_file_name = request.args.get('song_file_name')
     print(song_url)
-    song = SongFinder()
-    song._download_midi(song_url)
-    with open('state.json', 'r') as f:
-        file = json.load(f)
-    file['song'] = song_file_name
-    file['state'] = "song_set"
-
-    with open('state.json', 'w') as f:
-        json.dump(file, f)
+    if not song_file_name:
+        return jsonify({"message": "No song_file_name given."}), 400
+    # songs found in the index are already downloaded
+    if not os.path.isfile(os.path.join(DOWNLOADS_DIR, song_file_name)):
+        song = SongFinder()
+        song._download_midi(song_url)
+    if os.path.isfile(os.path.join(DOWNLOADS_DIR, song_file_name)):
+        corpus.add(os.path.join(DOWNLOADS_DIR, song_file_name))
+    state_store.set(song=song_file_name, state="song_set")
     return jsonify({"message": "Song set."})
 
 
 @app.route('/availableSongs', methods=['GET'])
 def availableSongs():
-    # get all the available songs from the assets/midi/downloads folder
-    songs = os.listdir('../assets/midi/downloads')
+    # get all the available songs from the corpus store's song table
+    songs = corpus.titles()
     return jsonify({"songs": songs})
 
 
 @app.route('/setLocalSong', methods=['GET'])
 def setLocalSong():
     song_file_name = request.args.get('song_file_name')
-    with open('state.json', 'r') as f:
-        file = json.load(f)
-    file['song'] = song_file_name
-    file['state'] = "song_set"
-
-    with open('state.json', 'w') as f:
-        json.dump(file, f)
+    state_store.set(song=song_file_name, state="song_set")
     return jsonify({"message": "Song set."})
 
 
 @app.route('/getSong', methods=['GET'])
 def getSong():
-    if os.path.exists('state.json'):
-        with open('state.json') as f:
-            song = json.load(f)['song']
-    return jsonify({"song": song})
+    return jsonify({"song": state_store.get("song")})
 
 
 if __name__ == '__main__':
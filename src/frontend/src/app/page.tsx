@@ -15,14 +15,12 @@ export default function Home() {
 
   // demoing recording feedback done
   useEffect(() => {
-    // call this function every second
-    console.log("here");
-    const interval = setInterval(() => {
-      axios.get(`${apiURL}/getState`).then((response: any) => {
-        setCurrentState(response.data.state);
-      });
-    }, 1000);
-    return () => clearInterval(interval);
+    // the server pushes every change of the state
+    const events = new EventSource(`${apiURL}/events`);
+    events.onmessage = (event: MessageEvent) => {
+      setCurrentState(JSON.parse(event.data).state);
+    };
+    return () => events.close();
   }, []);
 
   useEffect(() => {
@@ -47,8 +45,14 @@ export default function Home() {
     const response = await fetch(`${apiURL}/search?query=${userSearch}`);
     const data = await response.json();
     console.log(data);
+    // downloaded songs come back at once, the song site's results follow
     setSearchResults(data.results.slice(0, 7));
     setLoading(false);
+    if (!data.complete) {
+      const remote = await fetch(`${apiURL}/search?query=${userSearch}&wait=1`);
+      const remoteData = await remote.json();
+      setSearchResults(remoteData.results.slice(0, 7));
+    }
   };
 
   const handleSelectSong = async (song_url: string, song_file_name: string) => {
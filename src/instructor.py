@@ -1,25 +1,40 @@
+import time
+
 import mido
-from mido import MidiFile, MidiTrack
-from music21 import converter, stream, note
+from mido import MidiFile
 
 from player import Player
 from analyzer import Analyzer
-from typing import List
-import requests
-import time
+from snippets import SongSnippets
+from song_cache import SongCache
+from lesson_events import LessonEvents, HttpEvents
+from feedback import MISTAKE_MESSAGES, OTHER_MISTAKE_MESSAGE
+from typing import Union
+
+
+# the mistake type (see Analyzer.error_timeline) each kind of error reported live is described as
+LIVE_MISTAKE_TYPES = {"incorrect_pitches": "wrong_notes"}
 
 
 class Instructor:
 
     time_per_segment = 1
-
-    def __init__(self, player: Player, analyzer: Analyzer) -> None:
+    # seconds to wait for feedback to be shown (it may be rephrased first), and to leave it
+    # with the student before the next demo
+    feedback_timeout = 5
+    feedback_seconds = 5
+
+    def __init__(
+        self, player: Player, analyzer: Analyzer, song_cache: SongCache = None, events: LessonEvents = None
+    ) -> None:
         """
         Create a new Instructor object
 
         Args:
             player (Player): The player object to use
             analyzer (Analyzer): The analyzer object to use
+            song_cache (SongCache): Where preprocessed songs are kept, None to preprocess every time
+            events (LessonEvents): Where lesson states and feedback are sent, the server's routes by default
 
         Returns:
             None
@@ -27,50 +42,68 @@ class Instructor:
         self.type = "friendly"
         self.player = player
         self.analyzer = analyzer
+        self.song_cache = song_cache
+        self.events = events if events is not None else HttpEvents()
         self.lesson_state = "not_started"
 
     # def lesson(song)
-    def lesson(self, input_song_midi: mido.MidiFile) -> None:
+    def lesson(self, input_song_midi: Union[mido.MidiFile, str]) -> None:
         """
         Teach the user the song.
 
         Args:
-            input_song_midi (mido.MidiFile): The song to teach
+            input_song_midi (mido.MidiFile or str): The song to teach, or the path to its file
 
         Returns:
             None
         """
-        reference_snippets = get_song_snippets(input_song_midi)
+        reference_snippets = get_song_snippets(input_song_midi, self.song_cache)
+        # a cached song's snippets are graded against their quantized notes from the cache
+        reference_notes = None
+        if self.song_cache is not None and isinstance(input_song_midi, str):
+            reference_notes = self.song_cache.quantized_snippets(input_song_midi, self.analyzer.quantize_grid())
+        if self.song_cache is not None:
+            print("Song cache:", self.song_cache.stats())
         # reference_snippets = [input_song_midi]
 
         # loop until done
         current_snippet_idx = 0
         while len(reference_snippets) > 0 and current_snippet_idx < len(reference_snippets):
 
-            requests.get('http://localhost:5000/setState?state=demoing')
-
-            # *play* the next snippet
-            self.player.demo(reference_snippets[current_snippet_idx])
+            self.events.set_state("demoing")
 
-            requests.get('http://localhost:5000/setState?state=recording')
+            # only the snippet being taught is turned into a midi file
+            snippet = reference_snippets[current_snippet_idx]
+            reference_snippet = snippet.to_midi()
 
-            # *get* user attempt
+            # *play* the next snippet
+            self.player.demo(reference_snippet)
+
+            self.events.set_state("recording")
+            # the mistakes of the previous attempt are not this one's
+            self.events.set_live_mistake("")
+
+            # *get* user attempt, grading it as it is played
+            live_attempt = self.analyzer.start_attempt(
+                reference_snippet,
+                on_mistake=self._report_live_mistake,
+                verified_notes=snippet.verified_notes,
+                reference_notes=None if reference_notes is None else reference_notes[current_snippet_idx],
+            )
             student_attempt = self.player.record_attempt(
-                reference_snippets[current_snippet_idx]
+                reference_snippet, grader=live_attempt
             )
 
             # *analyze* their mistakes
-            is_sufficient, mistakes = self.analyzer.judge_attempt(
-                reference_midi=reference_snippets[current_snippet_idx],
-                user_midi=student_attempt,
-            )
+            is_sufficient, mistakes = live_attempt.verdict()
 
             if not is_sufficient:
                 self._correct_mistakes(mistakes)
                 continue
             current_snippet_idx += 1
 
-        requests.get('http://localhost:5000/setState?state=done')
+        self.events.set_state("done")
+        self.events.flush()
 
     def _correct_mistakes(self, mistake_timeline: dict) -> None:
         """
@@ -92,9 +125,7 @@ class Instructor:
             # TODO connect to user interface
             print(
                 "You're almost there! There's just one last thing to fix before we move on:")
-            requests.get(
-                'http://localhost:5000/setFeedback?feedback=' + advice)
-            time.sleep(5)
+            self.events.set_feedback(advice)
 
         # if the user made multiple mistakes, correct the most severe one
         else:
@@ -105,9 +136,27 @@ class Instructor:
 
             # TODO connect to user interface
             print("Here's one thing you can fix to make your performance even better:")
-            requests.get(
-                'http://localhost:5000/setFeedback?feedback=' + advice)
-            time.sleep(5)
+            self.events.set_feedback(advice)
+
+        # the next demo replaces the feedback on screen, so let the student take it in first
+        if self.events.wait_for_feedback(self.feedback_timeout):
+            time.sleep(self.feedback_seconds)
+
+    def _report_live_mistake(self, error_type: str, error: dict) -> None:
+        """
+        Report a mistake as soon as the user makes it.
+
+        Args:
+            error_type (str): The kind of mistake ("incorrect_pitches", "missing_notes" or "extra_notes")
+            error (dict): The mistake, in the format of the analyzer's errors dict
+
+        Returns:
+            None
+        """
+        # described like the mistakes of a finished attempt (see _correct_mistakes)
+        mistake_type = LIVE_MISTAKE_TYPES.get(error_type, error_type)
+        advice = f"Time {error['time']}: " + self._describe_mistake({"type": mistake_type, "errors": [error]})
+        self.events.set_live_mistake(advice)
 
     def _find_worst_mistake(self, mistake_timeline: dict) -> dict:
         """
@@ -146,36 +195,17 @@ class Instructor:
         Returns:
             str: A description of the mistake
         """
-        match mistake["type"]:
-            case "wrong_notes":
-                # if all notes are wrong in the same way, tell the user to transpose
-                delta = mistake["errors"][0][1]["reference_pitch"] - \
-                    mistake["errors"][0][1]["user_pitch"]
-                return "Some of your notes are slightly off here. Try again and pay extra attention here."
-
-                # if all([note[1]["reference_pitch"] - note[1]["user_pitch"] == delta for note in mistake["errors"]]):
-                #     return (f"Your notes are all off by {delta} semitones. Try transposing this {'note' if len(mistake['errors']) == 1 else 'chord'}"
-                #             f" {'up' if delta > 0 else 'down'}"
-                #             f" by {abs(delta)} semitones.")
-                # otherwise, give a general message
-            case "missing_notes":
-                if len(mistake["errors"]) == 1:
-                    return "You missed a note here. Try playing it again."
-                return "You missed some notes in this chord. Try playing them again."
-            case "extra_notes":
-                if len(mistake["errors"]) == 1:
-                    return "You played an extra note here. Try playing it again."
-                return "You played some extra notes in this chord. Try playing it again."
-            case "early_timing":
-                if len(mistake["errors"]) == 1:
-                    return "You played this note too early. Try playing it again."
-                return "You played these notes too early. Try playing them again."
-            case "late_timing":
-                if len(mistake["errors"]) == 1:
-                    return "You played this note too late. Try playing it again."
-                return "You played these notes too late. Try playing them again."
-            case _:
-                return "There was a mistake here. Try playing this part again."
+        # if all notes are wrong in the same way, tell the user to transpose
+        # delta = mistake["errors"][0][1]["reference_pitch"] - mistake["errors"][0][1]["user_pitch"]
+        # if all([note[1]["reference_pitch"] - note[1]["user_pitch"] == delta for note in mistake["errors"]]):
+        #     return (f"Your notes are all off by {delta} semitones. Try transposing this {'note' if len(mistake['errors']) == 1 else 'chord'}"
+        #             f" {'up' if delta > 0 else 'down'}"
+        #             f" by {abs(delta)} semitones.")
+        # otherwise, give a general message (the messages are rephrased ahead of time, see feedback.PhrasingTable)
+        if mistake["type"] not in MISTAKE_MESSAGES:
+            return OTHER_MISTAKE_MESSAGE
+        one_note, several_notes = MISTAKE_MESSAGES[mistake["type"]]
+        return one_note if len(mistake["errors"]) == 1 else several_notes
 
     # def _get_song_snippets(self, input_midi: MidiFile) -> List[MidiFile]:
     #     """
@@ -235,182 +265,18 @@ class Instructor:
     #     return snippets
 
 
-def get_song_snippets(input_midi: MidiFile) -> List[MidiFile]:
-    """
-    Split a song into snippets of notes each of duration `time_per_segment`.
+def get_song_snippets(input_midi: Union[MidiFile, str], song_cache: SongCache = None) -> SongSnippets:
     """
+    Split a song into lesson snippets: one per phrase, with a little overlap (see SongSnippets).
 
-    """# use music21 to split the song into snippets
-    myScore = converter.parse('../assets/midi/downloads/twinkle-twinkle-little-star.mid')
-    i = 1
-    snippets = []
-    while (measureStack := myScore.measure(i))[stream.Measure]:
-        notes = measureStack[note.Note]
-        snippets.append(notes)
-        i += 1
-
-    # create a list of snippets
-    snippets = []
-
-    return snippets"""
-    # print("INPUT_MIDI", input_midi)
-
-    tempo = 500000  # Default MIDI tempo (500,000 microseconds per beat)
-    for track in input_midi.tracks:
-        for msg in track:
-            if msg.type == "set_tempo":
-                tempo = msg.tempo
-                break  # find first tempo and break
-
-    ticks_per_second = input_midi.ticks_per_beat * (1_000_000 / tempo)
-
-    snippets = []
-    current_ticks = 0
-    current_snippet = MidiFile(ticks_per_beat=input_midi.ticks_per_beat)
-    current_track = MidiTrack()
-    current_snippet.tracks.append(current_track)
-
-    # merge all tracks into one
-    merged_track = MidiTrack()
-    for track in input_midi.tracks:
-        for msg in track:
-            if msg.type == "note_on" or msg.type == "note_off":
-                merged_track.append(msg)
-
-    # stack = {}
-    # for msg in merged_track:
-    #     if msg.note in stack:
-    #         merged_track.remove(msg)
-    #         continue
-    #     if msg.type == "note_on":
-    #         stack[msg.note] = msg
-    #     elif msg.type == "note_off":
-    #         if msg.note in stack:
-    #             del stack[msg.note]
-
-    # print("MERGED_TRACK", merged_track)
-    # print number of note_on and note_off messages
-    note_on_count = 0
-    note_off_count = 0
-
-    for msg in merged_track:
-        if msg.type == "note_on":
-            note_on_count += 1
-        elif msg.type == "note_off":
-            note_off_count += 1
-    print("note_on_count", note_on_count)
-    print("note_off_count", note_off_count)
-
-    notes_per_segment = 4
-
-    # pair up notes ahead of time (note_on, note_off)
-    note_pairs = []
-    assigned_noteoffs = [False for _ in range(len(merged_track))]
-    for i in range(len(merged_track)):
-        if merged_track[i].type == "note_on":
-            for j in range(i, len(merged_track)):
-                if assigned_noteoffs[j]:
-                    continue
-                if merged_track[j].type == "note_off" and merged_track[j].note == merged_track[i].note:
-                    note_pairs.append((i, j))
-                    assigned_noteoffs[j] = True
-                    break
-
-    # min_cutoff = 1
-    # i = 0
-    # while i < note_pairs[-1][1]:
-    #     if len(current_track) < notes_per_segment:
-
-    #         # add the smallest number of sequential notes possible while keeping both pair members in the snippet
-    #         for pair in note_pairs:
-    #             if pair[0] >= i:
-    #                 for j in range(pair[0], pair[1] + 1):
-    #                     if merged_track[j].type == "note_on" or merged_track[j].type == "note_off":
-    #                         current_track.append(merged_track[j])
-    #                     if merged_track[j].type == "note_on":
-    #                         for pair in note_pairs:
-    #                             if pair[0] == j:
-    #                                 min_cutoff = max(min_cutoff, pair[1])
-    #                                 break
-    #             if len(current_track) >= notes_per_segment:
-    #                 break
-
-    #         if pair[1] >= min_cutoff:
-    #             snippets.append(current_snippet)
-    #             current_snippet = MidiFile(
-    #                 ticks_per_beat=input_midi.ticks_per_beat)
-    #             current_track = MidiTrack()
-    #             current_snippet.tracks.append(current_track)
-    #             i = pair[1]
-
-    # # each snippet should contain all snippets before itself as well (0 1 2, 0 1 2 3, 0 1 2 3 4, etc.)
-    # additive_snippets = []
-    # for i in range(len(snippets)):
-    #     additive_snippets.append(
-    #         MidiFile(ticks_per_beat=input_midi.ticks_per_beat))
-    #     additive_snippets[i].tracks.append(MidiTrack())
-    #     for j in range(i + 1):
-    #         for msg in snippets[j].tracks[0]:
-    #             additive_snippets[i].tracks[0].append(msg)
-
-    # # for snippet in additive_snippets:
-    # #     # make sure that each note_on has a corresponding note_off use a stack
-    # #     stack = {}
-    # #     for msg in snippet.tracks[0]:
-    # #         if msg.type == "note_on":
-    # #             stack[msg.note] = msg
-    # #         elif msg.type == "note_off":
-    # #             if msg.note in stack:
-    # #                 del stack[msg.note]
-    # #             else:
-    # #                 stack[msg.note] = msg
-
-    # #     print(snippet.tracks[0], stack)
-
-    # #     # remove any unmatched note_offs
-    # #     # dont want the dictionary to change size during iteration
-    # #     stack_copy = stack.copy()
-    # #     for note in stack_copy:
-    # #         if stack[note].type == "note_off":
-    # #             snippet.tracks[0].remove(stack[note])
-    # #             del stack[note]
-
-    # #     # add a note_off for any unmatched note_ons
-    # #     stack_copy = stack.copy()
-    # #     for note in stack_copy:
-    # #         if stack[note].type == "note_on":
-    # #             snippet.tracks[0].append(
-    # #                 mido.Message("note_off", note=note, time=0))
-
-    # print("snippets", additive_snippets[0:3])
-    notes_per_segment = 4
-    snippets = []
-    i = 0
-    while i < len(merged_track):
-        current_snippet = MidiFile(ticks_per_beat=input_midi.ticks_per_beat)
-        current_track = MidiTrack()
-        current_snippet.tracks.append(current_track)
-
-        notes_added = 0
-        while i < len(merged_track) and notes_added < notes_per_segment:
-            msg = merged_track[i]
-            current_track.append(msg)
-            if msg.type == "note_off":
-                notes_added += 1
-            i += 1
-
-        if notes_added > 0:
-            snippets.append(current_snippet)
-
-    additive_snippets = []
-    for i in range(len(snippets)):
-        additive_snippets.append(
-            MidiFile(ticks_per_beat=input_midi.ticks_per_beat))
-        additive_snippets[i].tracks.append(MidiTrack())
-        for j in range(i + 1):
-            for msg in snippets[j].tracks[0]:
-                additive_snippets[i].tracks[0].append(msg)
-    return additive_snippets
+    The snippets are views on the song's notes; call `to_midi()` on one to get a MidiFile.
+    A song given as a path is looked up in `song_cache` first, if there is one.
+    """
+    if isinstance(input_midi, str):
+        if song_cache is not None:
+            return song_cache.song_snippets(input_midi)
+        input_midi = MidiFile(input_midi)
+    return SongSnippets.from_midi(input_midi)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,210 @@
+"""
+How the instructor tells the server (and through it the front end) what the
+lesson is doing: the state it is in, the feedback for the student and the
+mistakes the student makes while playing.
+
+- StoreEvents changes the server's state store directly, when the lesson
+  runs in the server's process.
+- HttpEvents calls the server's routes over one pooled keep-alive session.
+- BackgroundEvents wraps either of them: events are put on a queue and sent
+  by a background thread, in order, so the lesson never waits for them.
+"""
+
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from state_store import StateStore
+from feedback import FeedbackService
+
+
+class LessonEvents(ABC):
+    """
+    Where lesson events go. Subclasses send them somewhere, and cannot be made
+    without every method that sends one.
+    """
+
+    @abstractmethod
+    def set_state(self, state: str) -> None:
+        """
+        Args:
+            state (str): What the lesson is doing ("demoing", "recording", "feedback", "done"...)
+
+        Returns:
+            None
+        """
+
+    @abstractmethod
+    def set_feedback(self, feedback: str) -> None:
+        """
+        Args:
+            feedback (str): Advice for the student (the state becomes "feedback")
+
+        Returns:
+            None
+        """
+
+    @abstractmethod
+    def set_live_mistake(self, mistake: str) -> None:
+        """
+        Args:
+            mistake (str): A mistake the student just made, while still playing ("" to clear it)
+
+        Returns:
+            None
+        """
+
+    def flush(self) -> None:
+        """
+        Wait until every event sent so far has been delivered.
+
+        Returns:
+            None
+        """
+
+    @abstractmethod
+    def wait_for_feedback(self, timeout: float) -> bool:
+        """
+        Wait until the feedback sent last is shown to the student (the state becomes "feedback").
+        The feedback may be rephrased first, so it can take a while.
+
+        Args:
+            timeout (float): Seconds to wait at most
+
+        Returns:
+            bool: Whether the feedback is shown
+        """
+
+
+class StoreEvents(LessonEvents):
+
+    def __init__(self, store: StateStore, feedback_service: FeedbackService = None) -> None:
+        """
+        Args:
+            store (StateStore): The server's state store
+            feedback_service (FeedbackService): Rephrases advice and publishes it to the store,
+                None to show it as it is
+
+        Returns:
+            None
+        """
+        self.store = store
+        self.feedback_service = feedback_service
+
+    def set_state(self, state: str) -> None:
+        self.store.set(state=state)
+
+    def set_feedback(self, feedback: str) -> None:
+        if self.feedback_service is not None:
+            self.feedback_service.submit(feedback)
+        else:
+            self.store.set(feedback=feedback, state="feedback")
+
+    def set_live_mistake(self, mistake: str) -> None:
+        self.store.set(live_mistake=mistake)
+
+    def wait_for_feedback(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        version, state = self.store.snapshot()
+        while state["state"] != "feedback":
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            version, state = self.store.wait(version, remaining)
+        return True
+
+
+class HttpEvents(LessonEvents):
+
+    def __init__(self, base_url: str = "http://localhost:5000", timeout: float = 30) -> None:
+        """
+        Args:
+            base_url (str): Where the server is
+            timeout (float): Seconds to wait for the server to answer
+
+        Returns:
+            None
+        """
+        self.base_url = base_url
+        self.timeout = timeout
+
+        # one connection, kept open between events
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
+    def set_state(self, state: str) -> None:
+        self._get("/setState", state=state)
+
+    def set_feedback(self, feedback: str) -> None:
+        self._get("/setFeedback", feedback=feedback)
+
+    def set_live_mistake(self, mistake: str) -> None:
+        self._get("/setLiveMistake", mistake=mistake)
+
+    def wait_for_feedback(self, timeout: float) -> bool:
+        # long polls, answered as soon as the state changes
+        deadline = time.monotonic() + timeout
+        version = -1
+        while True:
+            remaining = max(deadline - time.monotonic(), 0)
+            state = self._get("/waitState", since=version, timeout=remaining).json()
+            if state["state"] == "feedback":
+                return True
+            if remaining == 0:
+                return False
+            version = state["version"]
+
+    def _get(self, route: str, **params) -> requests.Response:
+        response = self.session.get(self.base_url + route, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+
+class BackgroundEvents(LessonEvents):
+
+    def __init__(self, transport: LessonEvents) -> None:
+        """
+        Args:
+            transport (LessonEvents): Where the events are sent, from a background thread
+
+        Returns:
+            None
+        """
+        self.transport = transport
+        self._queue = queue.Queue()
+        threading.Thread(target=self._send_events, daemon=True).start()
+
+    def set_state(self, state: str) -> None:
+        self._queue.put((self.transport.set_state, state))
+
+    def set_feedback(self, feedback: str) -> None:
+        self._queue.put((self.transport.set_feedback, feedback))
+
+    def set_live_mistake(self, mistake: str) -> None:
+        self._queue.put((self.transport.set_live_mistake, mistake))
+
+    def flush(self) -> None:
+        self._queue.join()
+        self.transport.flush()
+
+    def wait_for_feedback(self, timeout: float) -> bool:
+        # the feedback has to be sent before it can be shown
+        deadline = time.monotonic() + timeout
+        self.flush()
+        return self.transport.wait_for_feedback(max(deadline - time.monotonic(), 0))
+
+    def _send_events(self) -> None:
+        while True:
+            send, value = self._queue.get()
+            try:
+                send(value)
+            except Exception as e:
+                # the lesson goes on without it
+                print(f"Could not send lesson event {value!r}: {e}")
+            finally:
+                self._queue.task_done()
@@ -1,3 +1,32 @@
+import importlib
+
 from .pymidifile import *
-from .features_from_midi import *
+from .note_matrix import *
 from .reformat_midi import *
+
+# features_from_midi needs music21 and pandas, which are slow to import,
+# so its functions are only imported the first time one of them is used.
+_LAZY_NAMES = {
+    'FEATURES_VERSION': 'features_from_midi',
+    'extract_features': 'features_from_midi',
+    'note_features': 'features_from_midi',
+    'cached_features': 'features_from_midi',
+    'extract_all': 'features_from_midi',
+    'save_features': 'features_from_midi',
+    'load_features': 'features_from_midi',
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_NAMES:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+    module = importlib.import_module('.' + _LAZY_NAMES[name], __name__)
+    for lazy_name, module_name in _LAZY_NAMES.items():
+        if module_name == _LAZY_NAMES[name]:
+            globals()[lazy_name] = getattr(module, lazy_name)
+    return globals()[name]
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_NAMES))
@@ -0,0 +1,216 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Reformats (and quantizes) a whole library of midi files on a pool of processes.
+
+Every file is read and parsed once, reformatted once and written atomically
+(to a temporary file that then replaces the output), so an interrupted run
+never leaves a half-written file behind. A manifest next to the output
+remembers what each file looked like when it was processed and with which
+options, and files that have not changed since are skipped, unless the
+options have.
+
+"""
+
+import hashlib
+import io
+import json
+import os
+import time
+from multiprocessing import Pool
+
+from mido import MidiFile
+
+from libs.pymidifile import (reformat_midi, mid_to_notes, quantize_notes, matrix_to_mid,
+                             iter_folderfiles, write_atomically)
+
+
+MANIFEST_NAME = ".midi_batch.json"
+
+
+def process_midi(path, output_path=None, quantize=True, stepSize=0.25, quantizeDurations=False,
+                 override_time_info=True, previous=None):
+    """
+    Reformats one midi file, quantizes it if asked to, and writes the result.
+
+    Parameters
+    ----------
+    path: str
+        Midi file to process.
+    output_path: str
+        Where to write the result, the input file itself by default.
+    quantize: bool
+        Quantize the notes after reformatting.
+    stepSize: float
+        Quantisation grid, in quarter notes.
+    quantizeDurations: bool
+        Also quantize the note durations.
+    override_time_info: bool
+        Override original tempo and time signature (see reformat_midi).
+    previous: dict
+        The manifest record of the last time the file was processed, if any.
+
+    Return
+    ------
+    record: dict
+        Manifest record: path, output, status ("done", "skipped" or "failed"),
+        seconds taken, the size, mtime and hashes of the files, and the options
+        they were processed with.
+
+    """
+
+    start = time.perf_counter()
+    output_path = output_path or path
+    stat = os.stat(path)
+    options = {"quantize": quantize, "stepSize": stepSize, "quantizeDurations": quantizeDurations,
+               "override_time_info": override_time_info}
+    record = {"path": path, "output": output_path, "size": stat.st_size, "mtime": stat.st_mtime,
+              "options": options}
+
+    # a file processed with other options is processed again
+    if previous is not None and (previous.get("options") != options or not os.path.exists(output_path)):
+        previous = None
+
+    try:
+        if previous is not None:
+            # quick check on size and mtime, then on the contents
+            if previous["size"] == stat.st_size and previous["mtime"] == stat.st_mtime:
+                return dict(previous, status="skipped", seconds=time.perf_counter() - start)
+
+        with open(path, "rb") as f:
+            data = f.read()
+        source = hashlib.sha1(data).hexdigest()
+
+        if previous is not None:
+            # a file processed in place hashes to the output it was replaced with
+            if source in (previous["source"], previous["output_hash"]):
+                return dict(previous, size=stat.st_size, mtime=stat.st_mtime,
+                            status="skipped", seconds=time.perf_counter() - start)
+
+        mid = reformat_midi(MidiFile(file=io.BytesIO(data)), name=output_path, verbose=False,
+                            write_to_file=False, override_time_info=override_time_info)
+        if mid is None:
+            raise ValueError("midi file type 2 is not supported")
+
+        if quantize:
+            notes = quantize_notes(mid_to_notes(mid, override_time_info=override_time_info),
+                                   stepSize=stepSize, quantizeOffsets=True,
+                                   quantizeDurations=quantizeDurations)
+            mid = reformat_midi(matrix_to_mid(notes), name=output_path, verbose=False,
+                                write_to_file=False, override_time_info=override_time_info)
+
+        output = io.BytesIO()
+        mid.save(file=output)
+        output = output.getvalue()
+        write_atomically(output_path, output)
+
+        if output_path == path:
+            # the input is now the output
+            stat = os.stat(path)
+            record.update(size=stat.st_size, mtime=stat.st_mtime)
+
+        record.update(status="done", source=source, output_hash=hashlib.sha1(output).hexdigest())
+
+    except Exception as e:
+        record.update(status="failed", error="{}: {}".format(type(e).__name__, e))
+
+    record["seconds"] = time.perf_counter() - start
+    return record
+
+
+def _process_job(job):
+    path, output_path, previous, options = job
+    return process_midi(path, output_path, previous=previous, **options)
+
+
+def batch_process(input_dir, output_dir=None, recursive=False, processes=None, force=False,
+                  verbose=True, **options):
+    """
+    Processes every midi file in a directory on a pool of processes (see process_midi).
+
+    The file list is streamed to the workers while the directory is still being read.
+
+    Parameters
+    ----------
+    input_dir: str
+        Directory with the midi files.
+    output_dir: str
+        Where to write the results (mirroring the input's sub-folders), in place by default.
+    recursive: bool
+        Include sub-folders.
+    processes: int
+        Number of worker processes, one per core by default.
+    force: bool
+        Process files even if they have not changed since the last run.
+    verbose: bool
+        Print a line with the time taken for every file.
+    options:
+        quantize, stepSize, quantizeDurations and override_time_info, as in process_midi.
+
+    Return
+    ------
+    records: list
+        The manifest record of every file.
+
+    """
+
+    output_root = output_dir or input_dir
+    manifest_path = os.path.join(output_root, MANIFEST_NAME)
+    manifest = {}
+    if not force and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    def jobs():
+        for path in iter_folderfiles(input_dir, ext='.mid', recursive=recursive):
+            output_path = None
+            if output_dir is not None:
+                output_path = os.path.join(output_dir, os.path.relpath(path, input_dir))
+            yield path, output_path, manifest.get(path), options
+
+    start = time.perf_counter()
+    records = []
+    with Pool(processes) as pool:
+        for record in pool.imap_unordered(_process_job, jobs(), chunksize=4):
+            records.append(record)
+            if verbose:
+                print("{:8.3f} s  {:8}  {}{}".format(record["seconds"], record["status"], record["path"],
+                                                     "  " + record["error"] if "error" in record else ""))
+            if record["status"] != "failed":
+                manifest[record["path"]] = {key: value for key, value in record.items()
+                                            if key not in ("status", "seconds")}
+
+    os.makedirs(output_root, exist_ok=True)
+    write_atomically(manifest_path, json.dumps(manifest).encode())
+
+    if verbose:
+        counts = {status: sum(1 for r in records if r["status"] == status)
+                  for status in ("done", "skipped", "failed")}
+        elapsed = time.perf_counter() - start
+        print("{} files in {:.2f} s ({done} done, {skipped} skipped, {failed} failed), "
+              "{:.3f} s of work".format(len(records), elapsed, sum(r["seconds"] for r in records), **counts))
+
+    return records
+
+
+if __name__ == "__main__":
+
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Reformat and quantize a directory of midi files in parallel.")
+    parser.add_argument("input", help="Directory with the midi files.")
+    parser.add_argument("-o", "--output", help="Output directory (default: overwrite the input files).")
+    parser.add_argument("-r", "--recursive", action="store_true", help="Analyse subdirectories recursively.")
+    parser.add_argument("-j", "--processes", type=int, help="Number of worker processes (default: one per core).")
+    parser.add_argument("--no-quantize", action="store_true", help="Only reformat, do not quantize.")
+    parser.add_argument("-s", "--step", type=float, default=0.25, help="Quantisation grid in quarter notes.")
+    parser.add_argument("-d", "--durations", action="store_true", help="Quantize note durations too.")
+    parser.add_argument("--override", action="store_true", help="Override original tempo and time signature.")
+    parser.add_argument("-f", "--force", action="store_true", help="Process files even if they are unchanged.")
+
+    args = parser.parse_args()
+
+    batch_process(args.input, args.output, recursive=args.recursive, processes=args.processes,
+                  force=args.force, quantize=not args.no_quantize, stepSize=args.step,
+                  quantizeDurations=args.durations, override_time_info=args.override)
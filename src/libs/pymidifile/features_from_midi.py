@@ -4,8 +4,14 @@
 """
 Extract musical features from midifiles.
 
-When called from the command line, the script will generate
-a JSON file with the results of the analysis.
+Features are computed from the note array of each file (see mid_to_notes),
+which is read and parsed once. Only the pitch-class set features (normal
+order, prime form, Forte class...) go through music21, on a chord built
+from the file's pitches rather than on a parsed score.
+
+When called from the command line, the script analyses the files on a pool
+of processes, caches the features of every file by the hash of its contents,
+and writes the results as columns to a .npz (or .parquet, or .json) file.
 
 Ángel Faraldo, 2017.
 
@@ -13,19 +19,28 @@ a JSON file with the results of the analysis.
 
 from libs.pymidifile import *
 from pandas import Series as s, DataFrame as df
+from multiprocessing import Pool
 import music21 as m21
+import hashlib
+import io
+import json
 import os
+import time
 import numpy as np
 
 
+# bump whenever a feature is added or computed differently, so cached features are redone
+FEATURES_VERSION = 1
+
+
 def extract_features(mid):
     """
     Extract musical features from a midi file.
 
     Parameters
     ----------
-    mid: str
-        Valid path to a midi file.
+    mid: str or MidiFile
+        Valid path to a midi file, or a parsed midi file.
 
     Return
     ------
@@ -34,41 +49,69 @@ def extract_features(mid):
 
     """
 
-    music = m21.converter.parseFile(mid, format('midi'))
-    midi_raw = parse_mid(mid)
-    note_matrix = mid_to_matrix(midi_raw)
+    mid = parse_mid(mid)
+    features = note_features(mid)
+    return s(features, name=features['path'])
+
+
+def note_features(mid):
+    """
+    Computes the features of a parsed midi file from its notes.
+
+    Notes are ordered by onset, and notes with the same onset (chords) by pitch.
+
+    Parameters
+    ----------
+    mid: MidiFile
+        A parsed midi file.
+
+    Return
+    ------
+    features: dict
+        The features, as plain Python values.
+
+    """
+
+    notes = mid_to_notes(mid, override_time_info=True)
+    if notes is None or len(notes) == 0:
+        raise ValueError("No notes to analyse in {}.".format(mid.filename))
+    notes = NoteMatrix(notes.notes[np.lexsort((notes['pitch'], notes['onset']))])
+
+    onsets = notes['onset']
+    ends = onsets + notes['duration']
+    midi_seq = notes['pitch'].tolist()
 
     features = dict()
-    features['path'] = mid
-    print("file path: {}".format(mid))
+    features['path'] = mid.filename
 
     # look for simoultaneous attacks of two or more notes
-    features['poly'] = music.flat.hasElementOfClass('Chord')
+    features['poly'] = bool(np.any(np.diff(onsets) == 0))
 
     # chech for pitchwheel messages (aka glissandi)
-    features['pw'] = has_pitchwheel(midi_raw)
+    features['pw'] = any(msg.type == 'pitchwheel' for track in mid.tracks for msg in track)
 
     # the raw sequence
-    seq = m21.chord.Chord(music.flat.pitches)
-    midi_seq = [event.midi for event in seq.pitches]
     features['seq'] = midi_seq
 
     # first pitch in the sequence
-    features['fst'] = seq[0].pitch.midi
+    features['fst'] = midi_seq[0]
 
     # last pitch in the sequence
-    features['lst'] = seq[-1].pitch.midi
+    features['lst'] = midi_seq[-1]
 
     # interval between last and first note
     features['li'] = features['fst'] - features['lst']
 
     # all melodic intervals
-    features['mis'] = np.append(np.diff(midi_seq), (features['li']))
+    features['mis'] = np.append(np.diff(midi_seq), (features['li'])).tolist()
 
     # sequence of non redundant pitch events
-    p_seq = [event.pitch.midi for event in seq.removeRedundantPitches(inPlace=False)]
+    p_seq = list(dict.fromkeys(midi_seq))
     features['seqp'] = p_seq
 
+    # the pitch-class set features only depend on the pitches present
+    seq = m21.chord.Chord([m21.pitch.Pitch(midi=pitch) for pitch in p_seq])
+
     # 'compact' form, normal order
     n_order = seq.normalOrder
     features['no'] = seq.formatVectorString(n_order)
@@ -90,19 +133,19 @@ def extract_features(mid):
     features['name'] = seq.commonName
 
     # length in bars
-    features['bars'] = dur_in_bars(midi_raw)
+    features['bars'] = _length_in_bars(mid)
 
     # total number of events
-    features['ne'] = len(seq)
+    features['ne'] = len(midi_seq)
 
     # average events per bar
-    features['aveb'] = features['ne'] / features['bars']
+    features['aveb'] = features['ne'] / features['bars'] if features['bars'] else None
 
     # number of different pitches (octaves count)
     features['np'] = len(p_seq)
 
     # number of chromas
-    features['npc'] = seq.pitchClassCardinality
+    features['npc'] = len({pitch % 12 for pitch in p_seq})
 
     # lowest tone in sequence
     features['lo'] = min(midi_seq)
@@ -119,87 +162,213 @@ def extract_features(mid):
     # first pitch to central pitch interval
     features['ftc'] = features['fst'] - features['cp']
 
+    # attacks: notes with the same onset count as one (a chord), lasting until its longest note ends
+    attacks, first = np.unique(onsets, return_index=True)
+    attack_ends = np.maximum.reduceat(ends, first)
+
     # min inter-onset time
-    features['miot'] = min_iot(music)
+    features['miot'] = float(np.diff(attacks).min()) if len(attacks) > 1 else None
 
     # find overlapping notes
-    features['ovl'] = find_overlap(music)
+    features['ovl'] = bool(np.any(attack_ends[:-1] > attacks[1:]))
+
+    return features
+
+
+def _length_in_bars(mid):
+    # the longest track, in bars of the last time signature (as dur_in_bars does for type 0 files)
+    beats_per_bar = 4
+    dur_in_ticks = 0
+    for track in mid.tracks:
+        track_ticks = 0
+        for msg in track:
+            track_ticks += msg.time
+            if msg.type == 'time_signature':
+                beats_per_bar = msg.numerator
+        dur_in_ticks = max(dur_in_ticks, track_ticks)
+
+    return dur_in_ticks / (beats_per_bar * mid.ticks_per_beat)
 
-    # average time between attacks
-    # features['ata'] = m21.features.jSymbolic.AverageTimeBetweenAttacksFeature(music).extract().vector
 
-    # std time between attacks
-    # features['vata'] = m21.features.jSymbolic.VariabilityOfTimeBetweenAttacksFeature(music).extract().vector
+def cached_features(path, cache_dir=None):
+    """
+    Extract the features of a midi file, or load them from the cache if the file's
+    contents have been analysed before.
 
-    # Note Density Feature
-    # features['nd'] = m21.features.jSymbolic.NoteDensityFeature(music).extract().vector
+    Parameters
+    ----------
+    path: str
+        Valid path to a midi file.
+    cache_dir: str
+        Folder with one JSON file of features per analysed file contents, None for no cache.
 
-    # tonal certainty (as implemented in m21)!
-    # features['tc'] = m21.features.native.TonalCertainty(music).extract().vector
+    Return
+    ------
+    features: dict
+        The features, as plain Python values.
 
-    # amount of arpeggiation
-    # features['arp'] = m21.features.jSymbolic.AmountOfArpeggiationFeature(music).extract().vector
+    """
 
-    # highest time in file according to music21
-    # features['dur'] = music.highestTime
+    with open(path, 'rb') as f:
+        data = f.read()
 
-    # average melodic interval
-    # features['ami'] = m21.features.jSymbolic.AverageMelodicIntervalFeature(music).extract().vector
+    cache_path = None
+    if cache_dir is not None:
+        key = "{}-v{}".format(hashlib.sha1(data).hexdigest(), FEATURES_VERSION)
+        cache_path = os.path.join(cache_dir, key + '.json')
+        try:
+            with open(cache_path) as f:
+                features = json.load(f)
+            # the same contents may be cached under another name
+            features['path'] = path
+            return features
+        except (OSError, ValueError):
+            pass
 
-    # most common melodic interval
-    # features['mcmi'] = m21.features.jSymbolic.MostCommonMelodicIntervalFeature(music).extract().vector
+    features = note_features(MidiFile(path, file=io.BytesIO(data)))
 
-    # repeated notes
-    # features['rn'] = m21.features.jSymbolic.RepeatedNotesFeature(music).extract().vector
+    if cache_path is not None:
+        write_atomically(cache_path, json.dumps(features).encode())
 
-    # melodic octave
-    # features['ami'] = m21.features.jSymbolic.MelodicOctavesFeature(music).extract().vector
+    return features
 
-    # stepwise motion
-    # features['swm'] = m21.features.jSymbolic.StepwiseMotionFeature(music).extract().vector
 
-    # Chromatic Motion
-    # features['chrm'] = m21.features.jSymbolic.ChromaticMotionFeature(music).extract().vector
+def _analyse_file(job):
+    path, cache_dir = job
+    start = time.perf_counter()
+    try:
+        features, error = cached_features(path, cache_dir), None
+    except Exception as e:
+        features, error = None, "{}: {}".format(type(e).__name__, e)
+    return path, features, error, time.perf_counter() - start
 
-    # returns a Pandas Series
-    return s(features, name=mid)
+
+def extract_all(midi_files, processes=None, cache_dir=None, verbose=True):
+    """
+    Extract the features of many midi files on a pool of processes.
+
+    Parameters
+    ----------
+    midi_files: iterable
+        Paths to midi files (a generator, such as iter_folderfiles, is consumed as the files are analysed).
+    processes: int
+        Number of worker processes, one per core by default.
+    cache_dir: str
+        Folder to cache the features of every file in (see cached_features), None for no cache.
+    verbose: bool
+        Print a line with the time taken for every file.
+
+    Return
+    ------
+    features
+        a pandas dataframe with one row per file that could be analysed, in the order given
+
+    """
+
+    database = []
+    with Pool(processes) as pool:
+        jobs = ((path, cache_dir) for path in midi_files)
+        for path, features, error, seconds in pool.imap(_analyse_file, jobs, chunksize=4):
+            if verbose:
+                print("{:8.3f} s  {}{}".format(seconds, path, "  " + error if error else ""))
+            if features is not None:
+                database.append(features)
+
+    return df(database, index=[features['path'] for features in database])
+
+
+def save_features(results, output):
+    """
+    Writes a dataframe of features to a file, in a format chosen by its extension:
+
+    - .npz: one array per column; list columns (seq, mis, seqp) are stored
+      flattened, with the end of every row in a '<column>_ends' array.
+    - .parquet: pandas' parquet writer (needs pyarrow or fastparquet).
+    - .json: one indented JSON object per file.
+
+    """
+
+    ext = os.path.splitext(output)[1]
+
+    if ext == '.parquet':
+        results.to_parquet(output)
+
+    elif ext == '.json':
+        # we could have simply used the Pandas method: results.to_json(output)
+        # but using the json module beautifies the json export file:
+        with open(output, 'w') as outfile:
+            json.dump(json.loads(results.to_json(orient='index')), outfile, indent=1)
+
+    else:
+        arrays = dict()
+        for column in results.columns:
+            values = results[column].tolist()
+            if values and isinstance(values[0], list):
+                arrays[column] = np.array([value for row in values for value in row])
+                arrays[column + '_ends'] = np.cumsum([len(row) for row in values])
+            elif any(value is None for value in values):
+                arrays[column] = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+            else:
+                arrays[column] = np.array(values)
+
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        write_atomically(output, buffer.getvalue())
+
+
+def load_features(path):
+    """
+    Reads a .npz file written by save_features back into a dataframe.
+
+    """
+
+    with np.load(path, allow_pickle=False) as arrays:
+        columns = dict()
+        for column in arrays.files:
+            if column.endswith('_ends'):
+                continue
+            values = arrays[column]
+            if column + '_ends' in arrays.files:
+                columns[column] = [row.tolist() for row in np.split(values, arrays[column + '_ends'][:-1])]
+            else:
+                columns[column] = values.tolist()
+
+    return df(columns, index=columns['path'])
 
 
 if __name__ == "__main__":
 
     from argparse import ArgumentParser
 
-    parser = ArgumentParser(description="Extract musical features from midi files, writing the results to a JSON file.")
+    parser = ArgumentParser(description="Extract musical features from midi files, writing the results to a .npz, .parquet or .json file.")
     parser.add_argument("input", help="Midi file or directory to analyse.")
-    parser.add_argument("-o", "--output", help="Specify a JSON file to write analysis results.")
+    parser.add_argument("-o", "--output", help="Specify a file to write analysis results.")
     parser.add_argument("-r", "--recursive", action="store_true", help="Analyse subdirectories recursively.")
+    parser.add_argument("-j", "--processes", type=int, help="Number of worker processes (default: one per core).")
+    parser.add_argument("-c", "--cache", help="Folder to cache the features of every file in.")
+    parser.add_argument("--no-cache", action="store_true", help="Analyse every file, even if it has been analysed before.")
     args = parser.parse_args()
 
     print("Extracting features from {0}".format(args.input))
 
+    if not args.cache:
+        args.cache = os.path.join(os.path.expanduser("~"), '.midistats_cache')
+    if args.no_cache:
+        args.cache = None
+
     if os.path.isfile(args.input):
-        results = extract_features(args.input)
+        results = df([cached_features(args.input, args.cache)], index=[args.input])
 
     elif os.path.isdir(args.input):
-        midi_files = folderfiles(args.input, ext='.mid', recursive=args.recursive)
-        database = []
-        for myFile in midi_files:
-            database.append(extract_features(myFile))
-
-        # put the results in a pandas dataframe:
-        results = df(database)
+        midi_files = iter_folderfiles(args.input, ext='.mid', recursive=args.recursive)
+        results = extract_all(midi_files, processes=args.processes, cache_dir=args.cache)
 
     else:
         raise IOError("Make sure your path is a valid file name or directory.")
 
     if not args.output:
-        args.output = os.path.join(os.path.expanduser("~"), '.midistats_analysis.json')
-
-    # we could have simply used the Pandas method: results.to_json(args.output)
-    # but using the json module beautifies the json export file:
+        args.output = os.path.join(os.path.expanduser("~"), '.midistats_analysis.npz')
 
-    import json
-    with open(args.output, 'w') as outfile:
-        json.dump(json.loads(results.to_json(orient='index')), outfile, indent=1)
+    save_features(results, args.output)
 
     print("Exporting results to {}\n".format(args.output))
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+A compact note matrix: one row per note, stored in a NumPy structured array.
+
+The nested-list matrices returned by mid_to_matrix cost several Python objects
+per note. A NoteMatrix keeps the same information (plus velocity and channel)
+in about 20 bytes per note, and operates on whole columns at once.
+
+"""
+
+import numpy as np
+
+
+NOTE_DTYPE = np.dtype([('pitch', np.int16),
+                       ('onset', np.float64),
+                       ('duration', np.float64),
+                       ('velocity', np.uint8),
+                       ('channel', np.uint8)])
+
+
+class NoteMatrix:
+    """
+    Notes with their pitch, onset and duration (in quarter notes), velocity and channel.
+
+    Indexing with a field name returns that column, with an integer a single
+    note, and with a slice, mask or index array a new NoteMatrix. Slices and
+    time windows are views on the same memory, not copies.
+
+    """
+
+    dtype = NOTE_DTYPE
+
+    def __init__(self, notes=None):
+        if notes is None:
+            notes = np.zeros(0, dtype=NOTE_DTYPE)
+        elif isinstance(notes, NoteMatrix):
+            notes = notes.notes
+        elif not isinstance(notes, np.ndarray) or notes.dtype != NOTE_DTYPE:
+            raise TypeError("Expected a structured array of dtype NOTE_DTYPE.")
+        self.notes = notes
+
+    @classmethod
+    def empty(cls, n):
+        return cls(np.zeros(n, dtype=NOTE_DTYPE))
+
+    @classmethod
+    def from_rows(cls, rows, velocity=100, channel=0):
+        """
+        Build a NoteMatrix from a nested-list matrix of [pitch, offset, duration] rows.
+
+        """
+        matrix = cls.empty(len(rows))
+        if len(rows) > 0:
+            columns = np.asarray(rows, dtype=np.float64)
+            matrix.notes['pitch'] = columns[:, 0]
+            matrix.notes['onset'] = columns[:, 1]
+            matrix.notes['duration'] = columns[:, 2]
+        matrix.notes['velocity'] = velocity
+        matrix.notes['channel'] = channel
+        return matrix
+
+    def to_rows(self):
+        """
+        Returns the nested-list matrix ([pitch, offset, duration] rows) used by mid_to_matrix.
+
+        """
+        return [[int(pitch), float(onset), float(duration)]
+                for pitch, onset, duration in zip(self.notes['pitch'].tolist(),
+                                                  self.notes['onset'].tolist(),
+                                                  self.notes['duration'].tolist())]
+
+    def __len__(self):
+        return len(self.notes)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.notes[key]
+        if isinstance(key, (int, np.integer)):
+            return self.notes[key]
+        return NoteMatrix(self.notes[key])
+
+    def __setitem__(self, key, value):
+        self.notes[key] = value
+
+    def __iter__(self):
+        return iter(self.notes)
+
+    def __repr__(self):
+        return "NoteMatrix({} notes)".format(len(self))
+
+    @property
+    def nbytes(self):
+        return self.notes.nbytes
+
+    def copy(self):
+        return NoteMatrix(self.notes.copy())
+
+    def sorted(self):
+        """
+        Returns a copy ordered by onset (notes with the same onset keep their order).
+
+        """
+        return NoteMatrix(self.notes[np.argsort(self.notes['onset'], kind='stable')])
+
+    def window(self, start, end):
+        """
+        Returns the notes with start <= onset < end, as a view.
+        The matrix must be sorted by onset.
+
+        """
+        onsets = self.notes['onset']
+        first = np.searchsorted(onsets, start, side='left')
+        last = np.searchsorted(onsets, end, side='left')
+        return NoteMatrix(self.notes[first:last])
+
+    def transpose(self, semitones=0):
+        """
+        Returns a copy with every pitch moved by the given number of semitones.
+
+        """
+        transposed = self.copy()
+        transposed.notes['pitch'] += semitones
+        return transposed
+
+    def quantize(self, stepSize=0.25, quantizeOffsets=True, quantizeDurations=True,
+                 triplets=False, swing=0.5, strength=1.0):
+        """
+        Returns a copy quantized to fit the desired grid. With the default grid this
+        follows the same rules as quantize_matrix has always used.
+
+        Args:
+            stepSize: quantisation factor in multiples or fractions of quarter notes.
+            quantizeOffsets: adjust onsets to grid
+            quantizeDurations: adjust durations to grid
+            triplets: use a triplet grid (three steps in the time of two)
+            swing: position of the off-beat within each pair of steps: 0.5 is straight, 2/3 a triplet swing
+            strength: how far notes are moved towards the grid, from 0 (not at all) to 1 (onto it)
+        """
+        quantized = self.copy()
+
+        if triplets:
+            stepSize = stepSize * 2 / 3
+
+        if quantizeOffsets:
+            onsets = self.notes['onset']
+            if swing == 0.5:
+                grid = _to_grid(onsets, stepSize, -stepSize * 0.5)
+            else:
+                grid = _to_swing_grid(onsets, stepSize, swing)
+            quantized.notes['onset'] = _apply_strength(onsets, grid, strength)
+
+        if quantizeDurations:
+            durations = self.notes['duration']
+            grid = np.where(durations < (stepSize * 0.5), stepSize,
+                            _to_grid(durations, stepSize, stepSize * 0.5))
+            quantized.notes['duration'] = _apply_strength(durations, grid, strength)
+
+        return quantized
+
+
+def _to_grid(values, stepSize, halfway):
+    # nearest multiple of stepSize; values exactly halfway move by `halfway`
+    beat_grid = 2 * (1.0 / stepSize)
+    scaled = values * beat_grid
+    steps = scaled % 2
+    return np.where(steps < 1.0, np.floor(scaled) / beat_grid,
+                    np.where(steps == 1.0, ((values + halfway) * beat_grid) / beat_grid,
+                             np.ceil(scaled) / beat_grid))
+
+
+def _to_swing_grid(values, stepSize, swing):
+    # each pair of steps has a grid point on the beat and one `swing` of the way through
+    period = 2 * stepSize
+    position = values % period
+    points = np.array([0.0, swing * period, period])
+    nearest = np.argmin(np.abs(position[:, None] - points[None, :]), axis=1)
+    return values - position + points[nearest]
+
+
+def _apply_strength(values, grid, strength):
+    if strength == 1.0:
+        return grid
+    return values + strength * (grid - values)
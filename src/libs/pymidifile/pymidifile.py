@@ -27,11 +27,18 @@ SANITY CHECKS:
 
 import os.path
 import math
+import tempfile
+import heapq
+from collections import deque
+from operator import itemgetter
 import numpy as np
-from pandas import DataFrame as pddf
-import music21 as m21
 from mido import MidiFile, MidiTrack, Message, MetaMessage
 
+from .note_matrix import NoteMatrix
+
+# music21 and pandas take most of the time it takes to import this package,
+# so they are only imported by the functions that use them.
+
 
 def parse_mid(mid):
     """
@@ -68,7 +75,7 @@ def dur_in_bars(mid):
     return dur_in_ticks / (beats_per_bar * mid.ticks_per_beat)
 
 
-def mid_to_matrix(mid, output='nested_list'):  # {"nested_list", "pandas"}
+def mid_to_matrix(mid, output='nested_list'):  # {"nested_list", "pandas", "note_matrix"}
     """
     Takes a midi file or stream and returns a matrix with rows representing midi events
     and columns representing midinote, offset position and event duration:
@@ -88,80 +95,217 @@ def mid_to_matrix(mid, output='nested_list'):  # {"nested_list", "pandas"}
         print("Midi file type {}. Reformat to type 0 before quantising.".format(mid.type))
         return None
 
-    resolution = mid.ticks_per_beat
+    notes, n_noteons, n_noteoffs = _collect_notes(absolute_times(mid.tracks[0]), mid.ticks_per_beat)
 
-    elapsed = 0
-    noteons = []
-    offsets = []
-    noteoffs = []
-    durations = []
-
-    for msg in mid.tracks[0]:
-        elapsed += msg.time
-        offset = elapsed / resolution
-        if msg.type == 'note_on':
-            noteons.append(msg.note)
-            offsets.append(offset)
-        if msg.type == 'note_off':
-            noteoffs.append(msg.note)
-            durations.append(offset)
-
-    print("Note On", len(noteons), "Note Off", len(noteoffs))
-    if not len(noteons) == len(noteoffs):
+    print("Note On", n_noteons, "Note Off", n_noteoffs)
+    if not n_noteons == n_noteoffs:
         print("Unmatcghing size. Reformat file first")
         return None
 
     else:
-        mnotes = []
-        for i in range(len(noteons)):
-            mnotes.append(
-                [noteons[i], offsets[i], durations[noteoffs.index(noteons[i])] - offsets[i]])
-            durations.pop(noteoffs.index(noteons[i]))
-            noteoffs.remove(noteons[i])
+        if output == 'nested_list':
+            return notes.to_rows()
+        elif output == 'pandas':
+            from pandas import DataFrame as pddf
+            return pddf(notes.to_rows(), columns=['pitch', 'offset', 'duration'])
+        elif output == 'note_matrix':
+            return notes
 
-        if output is 'nested_list':
-            return mnotes
-        elif output is 'pandas':
-            return pddf(mnotes, columns=['pitch', 'offset', 'duration'])
 
+def _collect_notes(messages, resolution, close_last_note=False):
+    """
+    Pairs the note_on and note_off messages of a sequence of (tick, message) pairs
+    (see absolute_times) into a NoteMatrix, with the notes in note_on order.
+
+    Open notes are queued per (channel, pitch) and a note_off closes the oldest one,
+    so overlapping notes of the same pitch are paired first in, first out, in a single
+    pass. A note_off with no open note is ignored. Notes still open at the end are closed
+    there if close_last_note is set (otherwise they get a duration of 0).
+
+    Returns the notes and the number of note_on and note_off messages found.
+
+    """
 
-def quantize_matrix(matrix, stepSize=0.25, quantizeOffsets=True, quantizeDurations=True):
+    elapsed = 0
+    pitches = []
+    starts = []
+    ends = []
+    velocities = []
+    channels = []
+    open_notes = {}
+    n_noteoffs = 0
+
+    for elapsed, msg in messages:
+        if msg.type == 'note_on' and msg.velocity > 0:
+            key = (msg.channel, msg.note)
+            queue = open_notes.get(key)
+            if queue is None:
+                queue = open_notes[key] = deque()
+            queue.append(len(pitches))
+            pitches.append(msg.note)
+            starts.append(elapsed)
+            ends.append(elapsed)
+            velocities.append(msg.velocity)
+            channels.append(msg.channel)
+        elif msg.type == 'note_off' or msg.type == 'note_on':
+            n_noteoffs += 1
+            queue = open_notes.get((msg.channel, msg.note))
+            if queue:
+                ends[queue.popleft()] = elapsed
+
+    if close_last_note:
+        for queue in open_notes.values():
+            for i in queue:
+                ends[i] = elapsed
+
+    notes = NoteMatrix.empty(len(pitches))
+    if len(pitches) > 0:
+        starts = np.asarray(starts, dtype=np.float64) / resolution
+        notes['pitch'] = pitches
+        notes['onset'] = starts
+        notes['duration'] = np.asarray(ends, dtype=np.float64) / resolution - starts
+        notes['velocity'] = velocities
+        notes['channel'] = channels
+
+    return notes, len(pitches), n_noteoffs
+
+
+def quantize_matrix(matrix, stepSize=0.25, quantizeOffsets=True, quantizeDurations=True,
+                    triplets=False, swing=0.5, strength=1.0):
     """
-    Quantize a note matrix to fit the desired grid.
+    Quantize a note matrix to fit the desired grid. Returns a new matrix of the
+    same kind (nested list or NoteMatrix); the input is left untouched.
 
     Args:
         matrix: a matrix containing midi events
         stepSize: quantisation factor in multiples or fractions of quarter notes.
         quantizeOffsets: adjust offsets to grid
         quantizeDurations: adjust durations to grid
+        triplets: use a triplet grid (three steps in the time of two)
+        swing: position of the off-beat within each pair of steps: 0.5 is straight, 2/3 a triplet swing
+        strength: how far notes are moved towards the grid, from 0 (not at all) to 1 (onto it)
     """
 
-    beat_grid = 2 * (1.0 / stepSize)
+    if isinstance(matrix, NoteMatrix):
+        return matrix.quantize(stepSize, quantizeOffsets, quantizeDurations, triplets, swing, strength)
 
-    for e in matrix:
+    quantized = NoteMatrix.from_rows(matrix).quantize(
+        stepSize, quantizeOffsets, quantizeDurations, triplets, swing, strength)
+    return [[e[0], onset, duration] + list(e[3:])
+            for e, onset, duration in zip(matrix, quantized['onset'].tolist(), quantized['duration'].tolist())]
 
-        if quantizeOffsets:
-            starts = (e[1] * beat_grid) % 2
-            if starts < 1.0:
-                e[1] = math.floor(e[1] * beat_grid) / beat_grid
-            elif starts == 1.0:
-                e[1] = ((e[1] - (stepSize * 0.5)) * beat_grid) / beat_grid
-            else:
-                e[1] = math.ceil(e[1] * beat_grid) / beat_grid
-
-        if quantizeDurations:
-            if e[2] < (stepSize * 0.5):
-                e[2] = stepSize
-            else:
-                durs = (e[2] * beat_grid) % 2
-                if durs < 1.0:
-                    e[2] = math.floor(e[2] * beat_grid) / beat_grid
-                elif durs == 1.0:
-                    e[2] = ((e[2] + (stepSize * 0.5)) * beat_grid) / beat_grid
-                else:
-                    e[2] = math.ceil(e[2] * beat_grid) / beat_grid
 
-    return matrix
+# meta messages that reformat_midi drops when flattening a file
+EXCLUDED_MSG_TYPES = frozenset({"sequence_number", "text", "copyright", "track_name", "instrument_name",
+                                "lyrics", "marker", "cue_marker", "device_name", "channel_prefix",
+                                "midi_port", "sequencer_specific", "end_of_track", 'smpte_offset'})
+
+
+def absolute_times(track):
+    """
+    Yields the messages of a track as (tick, message) pairs, with the absolute
+    time of each message in ticks.
+
+    """
+
+    tick = 0
+    for msg in track:
+        tick += msg.time
+        yield tick, msg
+
+
+def merged_messages(tracks, excluded=frozenset()):
+    """
+    Lazily merges the messages of several tracks into a single stream of
+    (tick, message) pairs, ordered by absolute time in ticks. Messages at the
+    same tick keep the order of their tracks.
+
+    This is a k-way merge on a heap of the next message of each track, so it takes
+    O(n log k) for n messages in k tracks and nothing is copied: the messages are
+    the ones of the tracks, with their original delta times.
+
+    Messages of an excluded type are left out, but the time they carried is not lost.
+
+    """
+
+    streams = [absolute_times(track) for track in tracks]
+    if len(streams) == 1:
+        merged = streams[0]
+    else:
+        merged = heapq.merge(*streams, key=itemgetter(0))
+
+    for tick, msg in merged:
+        if msg.type not in excluded:
+            yield tick, msg
+
+
+def mid_to_notes(mid, override_time_info=True):
+    """
+    Takes a midi file or stream and returns its notes as a NoteMatrix,
+    with onsets and durations in quarter notes.
+
+    Gives the same notes as mid_to_matrix(reformat_midi(mid)), but reads the
+    messages directly instead of building a reformatted copy of the file.
+    The input is left untouched.
+
+    """
+
+    mid = parse_mid(mid)
+
+    if mid.type == 2:
+        print("Midi file type {}. I did not dare to change anything.".format(mid.type))
+        return None
+
+    excluded = EXCLUDED_MSG_TYPES
+    if override_time_info:
+        excluded = excluded | {'time_signature', 'set_tempo'}
+
+    # tracks are merged by absolute time, as reformat_midi flattens them
+    notes, _, _ = _collect_notes(merged_messages(mid.tracks, excluded), mid.ticks_per_beat, close_last_note=True)
+
+    return notes
+
+
+def quantize_notes(notes, stepSize=0.25, quantizeOffsets=True, quantizeDurations=True,
+                   triplets=False, swing=0.5, strength=1.0):
+    """
+    Quantize a NoteMatrix (see mid_to_notes) to fit the desired grid,
+    with the same rules as quantize_matrix. Returns a new NoteMatrix.
+
+    Args:
+        notes: a NoteMatrix
+        stepSize: quantisation factor in multiples or fractions of quarter notes.
+        quantizeOffsets: adjust onsets to grid
+        quantizeDurations: adjust durations to grid
+        triplets: use a triplet grid (three steps in the time of two)
+        swing: position of the off-beat within each pair of steps: 0.5 is straight, 2/3 a triplet swing
+        strength: how far notes are moved towards the grid, from 0 (not at all) to 1 (onto it)
+    """
+
+    return NoteMatrix(notes).quantize(stepSize, quantizeOffsets, quantizeDurations, triplets, swing, strength)
+
+
+def notes_to_onset_ticks(notes, ticks_per_beat=96):
+    """
+    Returns the pitches and absolute onset ticks of a NoteMatrix, in the order and
+    with the tick rounding that matrix_to_mid would write them.
+
+    """
+
+    # note_ons and note_offs in the order matrix_to_mid writes them
+    n = len(notes)
+    times = np.empty(2 * n)
+    times[0::2] = notes['onset']
+    times[1::2] = notes['onset'] + notes['duration']
+    order = np.argsort(times, kind='stable')
+
+    # every message's delta time is rounded down on its own
+    sorted_times = times[order]
+    deltas = np.diff(sorted_times, prepend=0.0)
+    ticks = np.cumsum((deltas * ticks_per_beat).astype(np.int64))
+
+    is_on = order % 2 == 0
+    return notes['pitch'][order[is_on] // 2], ticks[is_on]
 
 
 def transpose_matrix(matrix, tranpose=0):
@@ -169,6 +313,9 @@ def transpose_matrix(matrix, tranpose=0):
     Transposes the pitches of a note matrix by the desired factor.
 
     """
+    if isinstance(matrix, NoteMatrix):
+        return matrix.transpose(tranpose)
+
     for e in matrix:
         e[0] += tranpose
 
@@ -176,6 +323,9 @@ def transpose_matrix(matrix, tranpose=0):
 
 
 def onset_vector(matrix, stepsize=0.25, n_beats=None, fold=False):
+    if isinstance(matrix, NoteMatrix):
+        matrix = matrix.to_rows()
+
     onsets = []
     for event in matrix:
         onsets.append(event[1])
@@ -212,6 +362,9 @@ def onset_vector(matrix, stepsize=0.25, n_beats=None, fold=False):
 
 
 def dur_matrix(matrix, stepsize=0.25, n_beats=None, fold=False):
+    if isinstance(matrix, NoteMatrix):
+        matrix = matrix.to_rows()
+
     onsets = []
     for event in matrix:
         onsets.append(event[1])
@@ -283,6 +436,9 @@ def matrix_to_mid(matrix, output_file=None, ticks_per_beat=96, vel=100):
         track.append(MetaMessage("time_signature",
                      numerator=4, denominator=4, time=int(0)))
 
+    if isinstance(matrix, NoteMatrix):
+        matrix = matrix.to_rows()
+
     sort_events = []
     for row in matrix:
         sort_events.append([row[0], 1, row[1]])
@@ -400,6 +556,7 @@ def find_matching_scales(pcs):
 
 
 def force_4_bar(m21_stream):
+    import music21 as m21
     if m21_stream.highestTime == 8:
         four_bar_loop = m21.stream.Stream()
         four_bar_loop.repeatAppend(m21_stream, 2)
@@ -410,6 +567,7 @@ def force_4_bar(m21_stream):
 
 
 def duration_to_bars(stream, remove_tempo=True):
+    import music21 as m21
 
     if remove_tempo:
         stream[0].removeByClass('music21.tempo.MetronomeMark')
@@ -470,15 +628,18 @@ def count_bars(m21_stream):
 
 def load(mid):
     """Shortcut to load a midi file in the interactive shell."""
+    import music21 as m21
     return m21.converter.parseFile(mid, format('midi'))
 
 
 def view(mid):
+    import music21 as m21
     m21.converter.parseFile(mid, format('midi')).show('musicxml')
 
 
 def astext(mid):
     """Print a mid file in music21 text format in the console."""
+    import music21 as m21
     m21.converter.parseFile(mid, format('midi')).show('text')
 
 
@@ -547,33 +708,31 @@ def index_files(my_dir):
             file_count += 1
 
 
-def folderfiles(folderpath, ext=None, recursive=False):
+def iter_folderfiles(folderpath, ext=None, recursive=False):
     """
-    Returns a list of absolute paths with the files in the specified folder.
+    Yields the paths of the files in the specified folder as the folder is read,
+    without building the whole list first.
 
     """
     if recursive:
-        def _rlistdir(path):
-            rlist = []
-            for root, subdirs, files in os.walk(path):
-                for file in files:
-                    rlist.append(os.path.join(root, file))
-            return rlist
-
-        list_of_files = _rlistdir(folderpath)
+        for root, subdirs, files in os.walk(folderpath):
+            for file in files:
+                if not ext or os.path.splitext(file)[1] == ext:
+                    yield os.path.join(root, file)
 
     else:
-        list_of_files = [os.path.join(folderpath, item)
-                         for item in os.listdir(folderpath)]
-
-    my_files = []
-    for myFile in list_of_files:
-        if not ext:
-            my_files.append(myFile)
-        elif os.path.splitext(myFile)[1] == ext:
-            my_files.append(myFile)
-        else:
-            pass
+        with os.scandir(folderpath) as entries:
+            for entry in entries:
+                if not ext or os.path.splitext(entry.name)[1] == ext:
+                    yield os.path.join(folderpath, entry.name)
+
+
+def folderfiles(folderpath, ext=None, recursive=False):
+    """
+    Returns a list of absolute paths with the files in the specified folder.
+
+    """
+    my_files = list(iter_folderfiles(folderpath, ext=ext, recursive=recursive))
 
     if not my_files:
         raise FileNotFoundError(
@@ -582,6 +741,24 @@ def folderfiles(folderpath, ext=None, recursive=False):
         return my_files
 
 
+def write_atomically(path, data):
+    """
+    Writes bytes to a file through a temporary file in the same folder that then
+    replaces it, so that readers never see a half-written file.
+
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
 # def beat_hist(corpus_path, bars=1):
 #     """
 #     Returns a normalized vector with all elements adding to 1 representing
@@ -638,6 +815,7 @@ def has_pitchwheel(mid):
 
 
 def values_greater_than(my_dataframe, my_col, threshold=0):
+    from pandas import DataFrame as pddf
     counts = my_dataframe[my_col].value_counts()
     fields_kept = []
     for i in range(len(counts)):
@@ -651,6 +829,7 @@ def values_greater_than(my_dataframe, my_col, threshold=0):
 
 
 def n_most_frequent_values(my_dataframe, my_col, n_most_freq=6):
+    from pandas import DataFrame as pddf
     counts = my_dataframe[my_col].value_counts()
 
     if len(counts) <= n_most_freq:
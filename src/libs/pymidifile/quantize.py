@@ -4,6 +4,7 @@
 
 from argparse import ArgumentParser
 from reformat_midi import *
+from libs.pymidifile.batch import batch_process
 
 parser = ArgumentParser(description="Performs quantisation and reformatting of midi files.")
 parser.add_argument("input", help="Midi file or dir to reformat.")
@@ -23,14 +24,9 @@ if os.path.isfile(args.input):
     reformat_midi(track, name=args.input, verbose=args.verbose, write_to_file=True, override_time_info=args.override)
 
 elif os.path.isdir(args.input):
-    midi_files = folderfiles(args.input, ext='.mid', recursive=args.recursive)
-    for midi_file in midi_files:
-        reformat_midi(midi_file, verbose=args.verbose, write_to_file=True, override_time_info=args.override)
-        matrix = mid_to_matrix(midi_file)
-        quantizer = quantize_matrix(matrix, stepSize=0.25, quantizeOffsets=True, quantizeDurations=args.override)
-        track = matrix_to_mid(quantizer)
-        reformat_midi(track, name=midi_file, verbose=args.verbose, write_to_file=True, override_time_info=args.override)
-        print('\n')
+    # one process per core, skipping files that have not changed since the last run
+    batch_process(args.input, recursive=args.recursive, verbose=True, quantize=True, stepSize=0.25,
+                  quantizeDurations=args.override, override_time_info=args.override)
 
 else:
     raise IOError("Make sure your path is a valid file name or directory.")
@@ -1,9 +1,8 @@
-import time
-
 from instructor import Instructor
 from player import Player
 from analyzer import Analyzer
-import mido
+from song_cache import SongCache
+from lesson_events import BackgroundEvents, HttpEvents
 import requests
 import json
 
@@ -12,33 +11,41 @@ def main():
 
     requests.get('http://localhost:5000/setState?state=search')
 
-    # wait until the server is ready
+    # wait until the server is ready, woken up by the server as soon as the state changes
+    version = -1
     while True:
-        response = requests.get('http://localhost:5000/getState')
+        response = requests.get(
+            'http://localhost:5000/waitState', params={'since': version, 'timeout': 25}, timeout=30)
 
-        hi = response.json()
-        if response.json()['state'] == "teach":
+        state = response.json()
+        if state['state'] == "teach":
             break
-        time.sleep(1)
+        version = state['version']
 
     # create the player
     player = Player()
 
+    # preprocessed songs are kept between lessons
+    song_cache = SongCache()
+
     # create the analyzer
-    analyzer = Analyzer()
+    analyzer = Analyzer(song_cache=song_cache)
+
+    # lesson events are sent to the server in the background, so the lesson never waits for it
+    events = BackgroundEvents(HttpEvents())
 
     # create the instructor
-    instructor = Instructor(player, analyzer)
+    instructor = Instructor(player, analyzer, song_cache=song_cache, events=events)
 
     # get the song from the server
     response = requests.get('http://localhost:5000/getSong')
     song = response.json()['song']
     song = "Twinkle-Twinkle-Little-Star-Demo.mid"
     # reformat the response from '/twinkle-3-mid' to '../assets/midi/downloads/twinkle-3.mid'
-    input_song_midi = mido.MidiFile(f"../assets/midi/downloads/{song}")
+    input_song_path = f"../assets/midi/downloads/{song}"
 
     # start the lesson
-    instructor.lesson(input_song_midi)
+    instructor.lesson(input_song_path)
 
     # end the lesson
     return
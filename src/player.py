@@ -116,7 +116,7 @@ class Player:
         self.active_blacks = []
         pygame.display.quit()
 
-    def record_attempt(self, reference: mido.MidiFile) -> mido.MidiFile:
+    def record_attempt(self, reference: mido.MidiFile, grader=None) -> mido.MidiFile:
         self.timer, self.screen = self._init_pygame()
 
         start_time = time.time()
@@ -162,7 +162,7 @@ class Player:
                 (event_delta_time_seconds * 1000000) / (tempo / midi_file.ticks_per_beat))
 
             off_notes_added = self._process_midi_events(
-                midi_events, event_delta_time_ticks, track)
+                midi_events, event_delta_time_ticks, track, grader)
             current_notes += off_notes_added
             print(f"Current notes: {current_notes}/{total_notes}")
 
@@ -234,8 +234,9 @@ class Player:
             pygame.draw.rect(self.screen, color, [
                              draw_position, 0, self.black_width, self.HEIGHT // 1.5], 0, 2)
 
-    def _process_midi_events(self, midi_events, event_delta_time_ticks, track) -> int:
-        """Processes midi_events and returns number of new notes"""
+    def _process_midi_events(self, midi_events, event_delta_time_ticks, track, grader=None) -> int:
+        """Processes midi_events and returns number of new notes. Each note is also passed on to
+        the grader (see Analyzer.start_attempt), if there is one, as soon as it is played."""
         off_notes_added = 0
 
         for event in midi_events:
@@ -250,6 +251,8 @@ class Player:
                         "note_on", note=note, velocity=velocity, time=event_delta_time_ticks
                     )
                 )
+                if grader is not None:
+                    grader.note_on(note, event_delta_time_ticks)
                 if note_name in self.black_notes:
                     black_index = self.black_notes.index(note_name)
                     self.black_sounds[black_index].play()
@@ -270,6 +273,8 @@ class Player:
                         time=event_delta_time_ticks,
                     )
                 )
+                if grader is not None:
+                    grader.note_off(note, event_delta_time_ticks)
                 if note_name in self.black_notes:
                     black_index = self.black_notes.index(note_name)
                     self.active_blacks.remove(black_index)
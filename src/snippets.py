@@ -0,0 +1,280 @@
+"""
+Lesson snippets of a song, without copying the song for every snippet.
+
+The song is read once into a note array. A snippet is only a range of
+indexes into that array; a MidiFile is built from it when it is needed
+for playback or grading.
+
+The song is split into phrases at bar lines, rests and repeated bars. Each
+snippet is one phrase plus the last few notes of the phrase before it, so
+the lesson as a whole plays every note only a couple of times.
+"""
+
+from typing import List, Tuple
+
+import numpy as np
+from mido import MidiFile, MidiTrack, Message, MetaMessage
+
+from libs.pymidifile import NoteMatrix, mid_to_notes
+
+
+def song_timing(song: MidiFile) -> Tuple[int, float]:
+    """
+    Find the tempo and bar length of a song (the first ones it sets).
+
+    Args:
+        song (MidiFile): The song
+
+    Returns:
+        tuple: (tempo in microseconds per beat, beats per bar)
+    """
+    tempo = 500000  # Default MIDI tempo (500,000 microseconds per beat)
+    for track in song.tracks:
+        for msg in track:
+            if msg.type == "set_tempo":
+                tempo = msg.tempo
+                break  # find first tempo and break
+
+    beats_per_bar = 4
+    for track in song.tracks:
+        for msg in track:
+            if msg.type == "time_signature":
+                beats_per_bar = msg.numerator * 4 / msg.denominator
+                break
+
+    return tempo, beats_per_bar
+
+
+class Snippet:
+    """
+    A view on the notes [start, end) of a song.
+    """
+
+    def __init__(self, song: "SongSnippets", start: int, end: int, verified_notes: int = 0) -> None:
+        """
+        Args:
+            song (SongSnippets): The song the snippet is part of
+            start (int): Index of the first note of the snippet
+            end (int): Index after the last note of the snippet
+            verified_notes (int): Number of leading notes the student has already played correctly
+
+        Returns:
+            None
+        """
+        self.song = song
+        self.start = start
+        self.end = end
+        self.verified_notes = verified_notes
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def __repr__(self) -> str:
+        return f"Snippet(notes {self.start}-{self.end})"
+
+    @property
+    def notes(self) -> NoteMatrix:
+        return self.song.notes[self.start:self.end]
+
+    def to_midi(self) -> MidiFile:
+        """
+        Build a single track MidiFile with the notes of the snippet.
+
+        Returns:
+            MidiFile: The snippet, in the song's resolution and tempo
+        """
+        return self.song.to_midi(self.start, self.end)
+
+
+class SongSnippets:
+    """
+    A song split into lesson snippets: one per phrase, each starting with the
+    last `overlap_notes` notes of the phrase before it.
+    """
+
+    # a phrase is closed at a bar line once it spans this many bars
+    max_phrase_bars = 2
+    # phrases are never shorter than this, except for a song that is shorter
+    min_phrase_notes = 4
+    # a silence of at least this many beats ends a phrase
+    rest_beats = 1
+    # notes of the previous phrase that are repeated at the start of a snippet
+    overlap_notes = 2
+
+    def __init__(
+        self,
+        notes: NoteMatrix,
+        ticks_per_beat: int,
+        tempo: int = 500000,
+        beats_per_bar: float = 4,
+        phrases: List[Tuple[int, int]] = None,
+        ranges: List[Tuple[int, int]] = None,
+    ) -> None:
+        """
+        Args:
+            notes (NoteMatrix): The notes of the song, ordered by onset
+            ticks_per_beat (int): Resolution of the song
+            tempo (int): Tempo of the song, in microseconds per beat
+            beats_per_bar (float): Length of a bar, in beats
+            phrases (list): Phrase boundaries worked out before (see segment), None to work them out
+            ranges (list): Snippet boundaries worked out before (see lesson_plan), None to work them out
+
+        Returns:
+            None
+        """
+        self.notes = notes
+        self.ticks_per_beat = ticks_per_beat
+        self.tempo = tempo
+        self.beats_per_bar = beats_per_bar
+
+        # note times in the song's ticks, so snippets keep its exact timing
+        self.on_ticks = np.rint(self.notes["onset"] * self.ticks_per_beat).astype(np.int64)
+        self.off_ticks = np.rint(
+            (self.notes["onset"] + self.notes["duration"]) * self.ticks_per_beat
+        ).astype(np.int64)
+
+        self.phrases = phrases if phrases is not None else self.segment()
+        self.ranges = ranges if ranges is not None else self.lesson_plan(self.phrases)
+
+    @classmethod
+    def from_midi(cls, song: MidiFile) -> "SongSnippets":
+        """
+        Args:
+            song (MidiFile): The song to split
+
+        Returns:
+            SongSnippets: The song's snippets
+        """
+        tempo, beats_per_bar = song_timing(song)
+
+        notes = mid_to_notes(song, override_time_info=True)
+        if notes is None:
+            notes = NoteMatrix()
+
+        return cls(notes, song.ticks_per_beat, tempo=tempo, beats_per_bar=beats_per_bar)
+
+    def segment(self) -> List[Tuple[int, int]]:
+        """
+        Split the notes into phrases.
+
+        A phrase ends before a rest or a repeated bar, and otherwise at the
+        first bar line after it spans `max_phrase_bars` bars.
+
+        Returns:
+            list: (start, end) note index ranges, one per phrase
+        """
+        onsets = self.notes["onset"]
+        n = len(onsets)
+        if n == 0:
+            return []
+
+        bars = np.floor(onsets / self.beats_per_bar + 1e-9).astype(np.int64)
+        bar_starts = np.flatnonzero(np.diff(bars, prepend=-1)).tolist()
+
+        # notes that start a while after every earlier note has ended
+        ends = onsets + self.notes["duration"]
+        gaps = onsets[1:] - np.maximum.accumulate(ends)[:-1]
+        after_rest = set((np.flatnonzero(gaps >= self.rest_beats) + 1).tolist())
+
+        # bars whose notes (pitch and position in the bar) have been played before
+        repeats = set()
+        seen = set()
+        pitches = self.notes["pitch"].tolist()
+        positions = np.round(onsets - bars * self.beats_per_bar, 3).tolist()
+        bounds = bar_starts + [n]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            bar = (tuple(pitches[start:end]), tuple(positions[start:end]))
+            if bar in seen:
+                repeats.add(start)
+            seen.add(bar)
+
+        phrases = []
+        start = 0
+        for candidate in sorted(after_rest.union(bar_starts[1:])):
+            if candidate - start < self.min_phrase_notes:
+                continue
+            if (
+                candidate in after_rest
+                or candidate in repeats
+                or bars[candidate] - bars[start] >= self.max_phrase_bars
+            ):
+                phrases.append((start, candidate))
+                start = candidate
+
+        # a short tail joins the phrase before it
+        if phrases and n - start < self.min_phrase_notes:
+            start = phrases.pop()[0]
+        phrases.append((start, n))
+
+        return phrases
+
+    def lesson_plan(self, phrases: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        """
+        Turn phrases into snippets: each phrase plus the end of the one before it.
+
+        Args:
+            phrases (list): (start, end) note index ranges, as returned by segment
+
+        Returns:
+            list: (start, end) note index ranges, one per snippet
+        """
+        onsets = self.notes["onset"]
+        ranges = []
+        previous_start = 0
+        for start, end in phrases:
+            overlap_start = max(start - self.overlap_notes, previous_start)
+            # do not cut a chord in half
+            overlap_start = max(int(np.searchsorted(onsets, onsets[overlap_start])), previous_start)
+            ranges.append((overlap_start, end))
+            previous_start = start
+        return ranges
+
+    def __len__(self) -> int:
+        return len(self.ranges)
+
+    def __getitem__(self, i: int) -> Snippet:
+        start, end = self.ranges[i]
+        # the overlap with the previous phrase was approved with that phrase
+        return Snippet(self, start, end, verified_notes=self.phrases[i][0] - start)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_midi(self, start: int, end: int) -> MidiFile:
+        """
+        Build a single track MidiFile with the notes [start, end) of the song.
+
+        Args:
+            start (int): Index of the first note
+            end (int): Index after the last note
+
+        Returns:
+            MidiFile: The notes, in the song's resolution and tempo
+        """
+        notes = self.notes[start:end]
+        n = len(notes)
+
+        # note_ons and note_offs ordered by time (a note's on comes before its off)
+        ticks = np.empty(2 * n, dtype=np.int64)
+        ticks[0::2] = self.on_ticks[start:end]
+        ticks[1::2] = self.off_ticks[start:end]
+        order = np.argsort(ticks, kind="stable")
+        deltas = np.diff(ticks[order], prepend=ticks[order[0]] if n > 0 else 0)
+
+        pitches = notes["pitch"].tolist()
+        velocities = notes["velocity"].tolist()
+        channels = notes["channel"].tolist()
+
+        track = MidiTrack()
+        track.append(MetaMessage("set_tempo", tempo=self.tempo, time=0))
+        for event, delta in zip(order.tolist(), deltas.tolist()):
+            i = event // 2
+            if event % 2 == 0:
+                track.append(Message("note_on", note=pitches[i], velocity=velocities[i], channel=channels[i], time=delta))
+            else:
+                track.append(Message("note_off", note=pitches[i], velocity=0, channel=channels[i], time=delta))
+
+        snippet = MidiFile(ticks_per_beat=self.ticks_per_beat)
+        snippet.tracks.append(track)
+        return snippet
@@ -0,0 +1,217 @@
+"""
+On-disk cache of preprocessed songs.
+
+Parsing a midi file, extracting and quantizing its notes and splitting it
+into phrases only has to happen once per song. The results are stored as
+one .npz file per song under assets/cache, named after the hash of the
+file's contents and the version of the preprocessing pipeline, so an
+edited file or a changed pipeline never gets a stale entry. Entries that
+were read or made once are kept in memory, and only written again when
+something is added to them.
+"""
+
+import hashlib
+import io
+import os
+import zipfile
+
+import mido
+import numpy as np
+
+from libs.pymidifile import NoteMatrix, mid_to_notes, quantize_notes, write_atomically
+from snippets import SongSnippets
+
+
+class SongCache:
+
+    # bump whenever note extraction, quantization or segmentation changes
+    version = 1
+
+    def __init__(self, directory: str = "../assets/cache") -> None:
+        """
+        Args:
+            directory (str): Where the cache files are kept
+
+        Returns:
+            None
+        """
+        self.directory = directory
+        # entries read from disk, and songs preprocessed because they were not there
+        self.hits = 0
+        self.misses = 0
+        # keys of the files hashed so far, by path, with the size and mtime they had
+        self._keys = {}
+        # entries read or made so far, by key
+        self._entries = {}
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, path: str) -> str:
+        """
+        Args:
+            path (str): Path to a midi file
+
+        Returns:
+            str: The cache key of the file's current contents
+        """
+        # a file is only read and hashed again once it has changed
+        stat = os.stat(path)
+        known = self._keys.get(path)
+        if known is not None and known[0] == (stat.st_size, stat.st_mtime_ns):
+            return known[1]
+
+        with open(path, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        key = f"{digest}-v{self.version}"
+        self._keys[path] = ((stat.st_size, stat.st_mtime_ns), key)
+        return key
+
+    def load(self, key: str) -> dict:
+        """
+        Args:
+            key (str): Cache key (see key)
+
+        Returns:
+            dict: The arrays stored under the key, None if there are none
+        """
+        try:
+            with np.load(os.path.join(self.directory, key + ".npz"), allow_pickle=False) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except (OSError, ValueError, zipfile.BadZipFile):
+            # missing or unreadable
+            self.misses += 1
+            return None
+        self.hits += 1
+        return arrays
+
+    def store(self, key: str, arrays: dict) -> None:
+        """
+        Write an entry, replacing the whole file at once so readers never see half of it.
+
+        Args:
+            key (str): Cache key (see key)
+            arrays (dict): Arrays to store, by name
+
+        Returns:
+            None
+        """
+        data = io.BytesIO()
+        np.savez(data, **arrays)
+        write_atomically(os.path.join(self.directory, key + ".npz"), data.getvalue())
+
+    def entry(self, path: str) -> tuple:
+        """
+        The cache entry of a song, preprocessing and storing the song first on a miss.
+
+        Args:
+            path (str): Path to a midi file
+
+        Returns:
+            tuple: (key, arrays) of the entry
+        """
+        key = self.key(path)
+        arrays = self._entries.get(key)
+        if arrays is not None:
+            return key, arrays
+
+        arrays = self.load(key)
+        if arrays is None:
+            snippets = SongSnippets.from_midi(mido.MidiFile(path))
+            arrays = {
+                "notes": snippets.notes.notes,
+                "timing": np.array([snippets.ticks_per_beat, snippets.tempo, snippets.beats_per_bar], dtype=np.float64),
+                "phrases": np.array(snippets.phrases, dtype=np.int64).reshape(-1, 2),
+                "ranges": np.array(snippets.ranges, dtype=np.int64).reshape(-1, 2),
+            }
+            self.store(key, arrays)
+        self._entries[key] = arrays
+        return key, arrays
+
+    def song_snippets(self, path: str) -> SongSnippets:
+        """
+        The lesson snippets of a song, from the cache when it has them.
+
+        Args:
+            path (str): Path to a midi file
+
+        Returns:
+            SongSnippets: The song's snippets
+        """
+        _, entry = self.entry(path)
+        ticks_per_beat, tempo, beats_per_bar = entry["timing"].tolist()
+        return SongSnippets(
+            NoteMatrix(entry["notes"]),
+            int(ticks_per_beat),
+            tempo=int(tempo),
+            beats_per_bar=beats_per_bar,
+            phrases=[tuple(phrase) for phrase in entry["phrases"].tolist()],
+            ranges=[tuple(snippet) for snippet in entry["ranges"].tolist()],
+        )
+
+    def quantized_notes(self, path: str, grid: dict) -> NoteMatrix:
+        """
+        The notes of a song quantized the way the analyzer quantizes a reference
+        (see Analyzer.note_array), from the cache when it has them.
+
+        Args:
+            path (str): Path to a midi file
+            grid (dict): Quantization grid (see Analyzer.quantize_grids)
+
+        Returns:
+            NoteMatrix: The quantized notes
+        """
+        key, entry = self.entry(path)
+
+        # every grid asked for is added to the song's entry
+        name = "quantized_" + self._grid_name(grid)
+        if name not in entry:
+            entry[name] = quantize_notes(
+                NoteMatrix(entry["notes"]), quantizeOffsets=True, quantizeDurations=False, **grid
+            ).notes
+            self.store(key, entry)
+
+        return NoteMatrix(entry[name])
+
+    def quantized_snippets(self, path: str, grid: dict) -> list:
+        """
+        The notes of every lesson snippet of a song (see song_snippets), quantized the
+        way the analyzer quantizes the snippet's midi file, from the cache when it has them.
+
+        A snippet is quantized on its own: its notes are measured from its first note,
+        which is not on the grid in every song, so a slice of the quantized song can
+        differ from it.
+
+        Args:
+            path (str): Path to a midi file
+            grid (dict): Quantization grid (see Analyzer.quantize_grids)
+
+        Returns:
+            list: The quantized notes (NoteMatrix) of each snippet, in order
+        """
+        key, entry = self.entry(path)
+
+        # the snippets' notes one after the other, and where each snippet ends
+        name = "quantized_snippets_" + self._grid_name(grid)
+        if name not in entry:
+            quantized = [
+                quantize_notes(
+                    mid_to_notes(snippet.to_midi(), override_time_info=True),
+                    quantizeOffsets=True, quantizeDurations=False, **grid
+                ).notes
+                for snippet in self.song_snippets(path)
+            ]
+            entry[name] = np.concatenate(quantized) if quantized else entry["notes"][:0]
+            entry[name + "_ends"] = np.cumsum([len(notes) for notes in quantized], dtype=np.int64)
+            self.store(key, entry)
+
+        ends = entry[name + "_ends"].tolist()
+        return [NoteMatrix(entry[name][start:end]) for start, end in zip([0] + ends, ends)]
+
+    def _grid_name(self, grid: dict) -> str:
+        return ",".join(f"{option}={value}" for option, value in sorted(grid.items()))
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: Number of entries read from disk (hits) and of songs preprocessed (misses) so far
+        """
+        return {"hits": self.hits, "misses": self.misses}
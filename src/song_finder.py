@@ -1,69 +1,298 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 from mido import MidiFile
-import urllib
 
+from libs.pymidifile import write_atomically
+from ttl_cache import TTLCache
+from song_index import SongIndex, tokenize
 
-class SongFinder:
-    def search_and_download_midi(self, query):
-        search_url = f"https://bitmidi.com/search?q={query.replace(' ', '+')}"
 
-        # Set headers to mimic a browser request
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-        }
+BASE_URL = "https://bitmidi.com"
 
-        # Send a GET request to the search URL with headers
-        response = requests.get(search_url, headers=headers)
+# Set headers to mimic a browser request
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
+}
 
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.content, 'html.parser')
-            # Find all anchor tags with class 'searchResult'
-            search_results = soup.find_all('a', class_='pointer no-underline fw4 white underline-hover')
-
-            if search_results:
-                # Extract MIDI file URLs
-                search_results = [(a.text, a['href']) for a in search_results]
-                print(f"Found {len(search_results)} MIDI files:")
-                # donwload the first midi file
-                # TODO add a way to select which midi file to download
-                for i in range(len(search_results)):
-                    midi = self._download_midi(search_results[i][1])
-                    if midi:
-                        return midi
+
+class TokenBucket:
+    """
+    Rate limiter: `rate` requests per second on average, in bursts of up to `capacity`.
+    """
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        """
+        Args:
+            rate (float): Requests allowed per second
+            capacity (int): Requests allowed at once after a quiet spell
+
+        Returns:
+            None
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Wait until a request is allowed.
+
+        Returns:
+            float: Seconds waited
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # below zero, the token is taken in advance and paid for by waiting
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class SearchService:
+    """
+    Access to the song site: one pooled keep-alive session, rate-limited, with the
+    search results cached in memory and on disk. Identical searches made while one
+    is already running wait for its results instead of asking the site again.
+    """
+
+    def __init__(
+        self,
+        base_url: str = BASE_URL,
+        cache_dir: str = "../assets/cache/search",
+        ttl: float = 24 * 3600,
+        rate: float = 2.0,
+        burst: int = 4,
+        timeout: float = 10,
+    ) -> None:
+        """
+        Args:
+            base_url (str): The site (a local fake of it to test against)
+            cache_dir (str): Where search results are kept between runs, None to keep them in memory only
+            ttl (float): Seconds search results are kept for
+            rate (float): Requests per second sent to the site at most, on average
+            burst (int): Requests that can be sent at once after a quiet spell
+            timeout (float): Seconds to wait for the site to answer
+
+        Returns:
+            None
+        """
+        self.base_url = base_url
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.timeout = timeout
+        self.requests_sent = 0
+
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=4))
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=4))
+
+        self.rate_limit = TokenBucket(rate, burst)
+        self.results = TTLCache(maxsize=512, ttl=ttl)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="search")
+
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get(self, path: str) -> requests.Response:
+        """
+        Args:
+            path (str): Route on the site (for example "/search?q=twinkle"), or a full URL
+
+        Returns:
+            requests.Response: The site's answer
+        """
+        url = path if path.startswith(("http://", "https://")) else self.base_url + path
+        self.rate_limit.acquire()
+        self.requests_sent += 1
+        return self.session.get(url, timeout=self.timeout)
+
+    def cached(self, query: str) -> list:
+        """
+        Args:
+            query (str): What to search for
+
+        Returns:
+            list: The results of the same search made earlier, None if there are none (the site is not asked)
+        """
+        key = self._key(query)
+        results = self.results.get(key)
+        if results is None:
+            results = self._load(key)
+        return results
+
+    def search_async(self, query: str) -> Future:
+        """
+        Args:
+            query (str): What to search for
+
+        Returns:
+            Future: The results (see search), once the site has answered
+        """
+        return self._executor.submit(self.search, query)
+
+    def search(self, query: str) -> list:
+        """
+        Args:
+            query (str): What to search for
+
+        Returns:
+            list: (title, route) of every song found, empty if none were or the site could not be reached
+        """
+        key = self._key(query)
+        results = self.cached(key)
+        if results is not None:
+            return results
+
+        with self._lock:
+            running = self._in_flight.get(key)
+            if running is None:
+                running = self._in_flight[key] = Future()
+                leader = True
             else:
-                print("No search results found.")
-        else:
+                leader = False
+        if not leader:
+            return running.result()
+
+        try:
+            results = self._fetch(key)
+            running.set_result(results)
+        except BaseException as e:
+            running.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        return results
+
+    def _fetch(self, key: str) -> list:
+        try:
+            response = self.get(f"/search?q={key.replace(' ', '+')}")
+        except requests.RequestException as e:
+            print(f"Failed to retrieve search results: {e}")
+            return []
+
+        if response.status_code != 200:
             print("Failed to retrieve search results.")
+            return []
+
+        soup = BeautifulSoup(response.content, 'html.parser')
+        # Find all anchor tags with class 'searchResult'
+        search_results = soup.find_all('a', class_='pointer no-underline fw4 white underline-hover')
+        # Extract MIDI file URLs
+        results = [(a.text, a['href']) for a in search_results]
 
+        self.results.put(key, results)
+        self._store(key, results)
+        return results
 
-    def _download_midi(self, midi_url):
+    def _key(self, query: str) -> str:
+        return " ".join(query.lower().split())
+
+    def _cache_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+    def _load(self, key: str) -> list:
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._cache_path(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry["time"] + self.ttl < time.time():
+            return None
+        results = [tuple(result) for result in entry["results"]]
+        self.results.put(key, results)
+        return results
+
+    def _store(self, key: str, results: list) -> None:
+        if self.cache_dir is None:
+            return
+        entry = {"query": key, "time": time.time(), "results": results}
+        write_atomically(self._cache_path(key), json.dumps(entry).encode())
+
+
+# shared by every search, so they share the connection, cache and rate limit
+search_service = None
+# the downloaded songs, kept up to date as songs are downloaded
+song_index = None
+
+
+def get_search_service() -> SearchService:
+    global search_service
+    if search_service is None:
+        search_service = SearchService()
+    return search_service
+
+
+def get_song_index() -> SongIndex:
+    global song_index
+    if song_index is None:
+        song_index = SongIndex()
+    return song_index
+
+
+class SongFinder:
+
+    downloads_dir = "../assets/midi/downloads"
 
-        midi_url = f"https://bitmidi.com{midi_url}"
+    def __init__(self, service: SearchService = None, index: SongIndex = None) -> None:
+        self.service = service if service is not None else get_search_service()
+        self.index = index if index is not None else get_song_index()
 
-        # Set headers to mimic a browser request
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-        }
+    def search_and_download_midi(self, query):
+        search_results = self.service.search(query)
+
+        if search_results:
+            print(f"Found {len(search_results)} MIDI files:")
+            # donwload the first midi file
+            # TODO add a way to select which midi file to download
+            for i in range(len(search_results)):
+                midi = self._download_midi(search_results[i][1])
+                if midi:
+                    return midi
+        else:
+            print("No search results found.")
 
-        # Send a GET request to the MIDI file URL with headers
-        response = requests.get(midi_url, headers=headers)
+    def _download_midi(self, midi_url):
+
+        # Send a GET request to the MIDI file's page
+        response = self.service.get(midi_url)
 
         if response.status_code == 200:
             # find download link on page
             soup = BeautifulSoup(response.content, 'html.parser')
             title = soup.find('h1', class_='mv3 f3').text
 
+            path = os.path.join(self.downloads_dir, title)
+
             # if the file already exists, don't download it again
             try:
-                with open(f"../assets/midi/downloads/{title}", 'rb') as f:
+                with open(path, 'rb') as f:
                     print(f"MIDI file {title}.mid already exists.")
-                    return MidiFile(f'../assets/midi/downloads/{title}')
+                    self.index.add(path, route=midi_url)
+                    return MidiFile(path)
             except:
                 pass
 
             download_route = soup.find('a', {"download": f'{title}'})['href']
-            download_url = f"https://bitmidi.com{download_route}"
 
             # if the file is too big, don't download it
             #response = requests.head(download_url, allow_redirects=True)
@@ -72,40 +301,77 @@ class SongFinder:
                 #print("MIDI file is too big to download.")
                 #return
 
-            # Send a GET request to the download URL with headers
-            response = requests.get(download_url, headers=headers)
+            # Send a GET request to the download URL
+            response = self.service.get(download_route)
 
             if response.status_code == 200:
                 # Save the MIDI file to disk
-                with open(f"../assets/midi/downloads/{title}", 'wb') as f:
+                with open(path, 'wb') as f:
                     f.write(response.content)
                     print(f"Downloaded MIDI file: {title}.mid")
-                return MidiFile(f'../assets/midi/downloads/{title}')
+                # so the next search for it is answered locally
+                self.index.add(path, route=midi_url)
+                return MidiFile(path)
         else:
             print("Failed to download MIDI file.")
 
 def get_search_results(query):
-    search_url = f"https://bitmidi.com/search?q={query.replace(' ', '+')}"
+    return get_search_service().search(query)
 
-    # Set headers to mimic a browser request
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-    }
 
-    # Send a GET request to the search URL with headers
-    response = requests.get(search_url, headers=headers)
+def find_songs(query: str, limit: int = 7, wait: bool = False) -> tuple:
+    """
+    Search the downloaded songs first, and the song site only if they are not enough.
 
-    if response.status_code == 200:
-        soup = BeautifulSoup(response.content, 'html.parser')
-        # Find all anchor tags with class 'searchResult'
-        search_results = soup.find_all('a', class_='pointer no-underline fw4 white underline-hover')
+    The site's results are added after the local ones when they are cached. Otherwise,
+    unless `wait` is set, the site is searched in the background and the local results
+    are returned at once; the same search made again once the site has answered (or
+    with `wait`) gets both.
 
-        if search_results:
-            # Extract MIDI file URLs
-            search_results = [(a.text, a['href']) for a in search_results]
+    Args:
+        query (str): What to search for
+        limit (int): Number of results wanted
+        wait (bool): Whether to wait for the site if its results are needed and not cached
+
+    Returns:
+        tuple: ((title, route) of every song found, whether the site's results are in)
+    """
+    results = [(hit["title"], hit["route"] or "") for hit in get_song_index().search(query, limit)]
+    if len(results) >= limit or not query.strip():
+        return results, True
+
+    service = get_search_service()
+    remote = service.cached(query)
+    if remote is None:
+        if not wait:
+            service.search_async(query)
+            return results, False
+        remote = service.search(query)
+
+    # a downloaded song has no route if it was not found through the site, so it is matched by title too
+    seen_routes = {route for _, route in results if route}
+    seen_titles = {song_key(title) for title, _ in results}
+    for title, route in remote:
+        if len(results) >= limit:
+            break
+        if route not in seen_routes and song_key(title) not in seen_titles:
+            results.append((title, route))
+            seen_routes.add(route)
+            seen_titles.add(song_key(title))
+    return results, True
+
+
+def song_key(title: str) -> str:
+    """
+    Args:
+        title (str): Title of a song, or its file name
 
-            return search_results
+    Returns:
+        str: The title normalized, so the same song downloaded and on the site compare equal
+            ("Twinkle-Twinkle.mid" and "twinkle twinkle" both give "twinkle twinkle")
+    """
+    return " ".join(tokenize(title))
 
 
 if __name__ == '__main__':
-    get_search_results("twinkle twinkle little star")
\ No newline at end of file
+    get_search_results("twinkle twinkle little star")
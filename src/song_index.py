@@ -0,0 +1,326 @@
+"""
+Full-text index of the downloaded songs, so a search for a song that is
+already on disk is answered locally, without asking the song site.
+
+Songs are found by the words of their titles and by what they are like (their
+key, e.g. "g major"). Misspelled or unfinished words still match: every word
+of the index is also listed under its trigrams, and a query word is matched to
+the words sharing enough trigrams with it.
+
+The index is a few dictionaries in memory; only the songs' rows (title, route
+on the song site, key, note count, duration) are saved, to
+assets/cache/song_index.json, and the dictionaries are rebuilt from them on
+load. Songs are added one at a time, as they are downloaded (see
+SongFinder._download_midi), a directory at a time with build, or from the
+corpus store (see corpus.py) with build_from_corpus, which parses nothing.
+"""
+
+import json
+import os
+import re
+import threading
+
+import mido
+import numpy as np
+
+from libs.pymidifile import mid_to_notes, write_atomically
+
+
+PITCH_CLASSES = ["C", "C#", "D", "Eb", "E", "F", "F#", "G", "Ab", "A", "Bb", "B"]
+
+# Krumhansl-Kessler key profiles: how much each degree of the scale is heard in a key
+MAJOR_PROFILE = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+MINOR_PROFILE = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+
+
+def estimate_key(pitches: np.ndarray, durations: np.ndarray) -> str:
+    """
+    Estimate the key of a song from how long each pitch class sounds (Krumhansl-Schmuckler).
+
+    Args:
+        pitches (np.ndarray): Midi pitch of every note
+        durations (np.ndarray): Duration of every note
+
+    Returns:
+        str: The key (for example "G major"), None if there are no notes
+    """
+    if len(pitches) == 0:
+        return None
+    histogram = np.bincount(np.asarray(pitches) % 12, weights=durations, minlength=12)
+    if not histogram.any():
+        return None
+
+    best_key, best_score = None, -np.inf
+    for mode, profile in (("major", MAJOR_PROFILE), ("minor", MINOR_PROFILE)):
+        for tonic in range(12):
+            score = np.corrcoef(histogram, np.roll(profile, tonic))[0, 1]
+            if score > best_score:
+                best_key, best_score = f"{PITCH_CLASSES[tonic]} {mode}", score
+    return best_key
+
+
+def tokenize(text: str) -> list:
+    """
+    Args:
+        text (str): A title or query
+
+    Returns:
+        list: Its words, lower case ("Twinkle-Twinkle.mid" gives ["twinkle", "twinkle"])
+    """
+    text = re.sub(r"\.midi?$", "", text.lower())
+    return re.findall(r"[a-z0-9#]+", text)
+
+
+def trigrams(word: str) -> set:
+    """
+    Args:
+        word (str): A word
+
+    Returns:
+        set: Its trigrams, padded so the start and end of the word count too
+    """
+    padded = f" {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SongIndex:
+
+    # how much a match on a song's metadata counts, next to a match on its title
+    metadata_weight = 0.5
+    # how many trigrams a misspelled word must share with a word of the index (Jaccard similarity)
+    min_similarity = 0.4
+    # how much of the query a song must match to be a hit
+    min_score = 0.4
+
+    def __init__(self, path: str = "../assets/cache/song_index.json") -> None:
+        """
+        Args:
+            path (str): Where the songs' rows are saved, None to keep the index in memory only
+
+        Returns:
+            None
+        """
+        self.path = path
+        self.songs = {}
+        self._postings = {}  # word -> {title: weight}
+        self._grams = {}  # trigram -> words
+        self._lock = threading.Lock()
+
+        if self.path is not None and os.path.exists(self.path):
+            with open(self.path) as f:
+                for song in json.load(f):
+                    self._index_song(song)
+
+    def __len__(self) -> int:
+        return len(self.songs)
+
+    def __contains__(self, title: str) -> bool:
+        return title in self.songs
+
+    def add(self, path: str, title: str = None, route: str = None) -> dict:
+        """
+        Add a song to the index, or update it if the file has changed since it was added.
+
+        Args:
+            path (str): Path to a midi file
+            title (str): Title to index the song under, the file name by default
+            route (str): Where the song's page is on the song site, if it was downloaded from it
+
+        Returns:
+            dict: The song's row, None if the file could not be read
+        """
+        if self._update([(path, title or os.path.basename(path), route)]):
+            self._save()
+        return self.songs.get(title or os.path.basename(path))
+
+    def build(self, midi_directory: str) -> int:
+        """
+        Add every midi file of a directory that is new or has changed since it was added.
+
+        Args:
+            midi_directory (str): Directory with the midi files
+
+        Returns:
+            int: Number of songs added or updated
+        """
+        files = []
+        with os.scandir(midi_directory) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.lower().endswith((".mid", ".midi")):
+                    files.append((entry.path, entry.name, None))
+        changed = self._update(files)
+        if changed:
+            self._save()
+        return changed
+
+    def build_from_corpus(self, corpus) -> int:
+        """
+        Add every song of a corpus store that is new or has changed since it was added.
+
+        The store already holds the songs' notes and sizes, so no midi file is parsed.
+
+        Args:
+            corpus (CorpusStore): The store, built from the midi files first (see CorpusStore.build)
+
+        Returns:
+            int: Number of songs added or updated
+        """
+        changed = 0
+        for title in corpus.titles():
+            stored = corpus.metadata(title)
+            known = self.songs.get(title)
+            if known is not None and known["size"] == stored["size"] and known["mtime"] == stored["mtime"]:
+                continue
+            self._put(self._row(title, None, known, corpus.notes(title), stored["size"], stored["mtime"]))
+            changed += 1
+        if changed:
+            self._save()
+        return changed
+
+    def search(self, query: str, limit: int = 10) -> list:
+        """
+        Args:
+            query (str): Words of the title or of the key of the song, possibly misspelled or unfinished
+            limit (int): Number of songs returned at most
+
+        Returns:
+            list: Rows of the songs found, best match first, each with its "score" (1 when every word matched)
+        """
+        words = tokenize(query or "")
+        if not words:
+            return []
+
+        with self._lock:
+            scores = {}
+            for word in words:
+                best = {}
+                for term, similarity in self._expand(word):
+                    for title, weight in self._postings[term].items():
+                        best[title] = max(best.get(title, 0.0), similarity * weight)
+                for title, score in best.items():
+                    scores[title] = scores.get(title, 0.0) + score
+
+            hits = []
+            for title, score in scores.items():
+                score /= len(words)
+                if score >= self.min_score:
+                    hits.append(dict(self.songs[title], score=round(score, 3)))
+
+        # best match first, then the shortest title (the closest to the query)
+        hits.sort(key=lambda hit: (-hit["score"], len(hit["title"]), hit["title"]))
+        return hits[:limit]
+
+    def _expand(self, word: str) -> list:
+        # the words of the index a query word may stand for, with how alike they are
+        if word in self._postings:
+            return [(word, 1.0)]
+        if len(word) < 3:
+            return []
+
+        grams = trigrams(word)
+        shared = {}
+        for gram in grams:
+            for term in self._grams.get(gram, ()):
+                shared[term] = shared.get(term, 0) + 1
+
+        terms = []
+        for term, common in shared.items():
+            similarity = common / (len(grams) + len(trigrams(term)) - common)
+            if similarity >= self.min_similarity:
+                terms.append((term, similarity))
+        return terms
+
+    def _update(self, files: list) -> int:
+        changed = 0
+        for path, title, route in files:
+            stat = os.stat(path)
+            known = self.songs.get(title)
+            if known is not None and known["size"] == stat.st_size and known["mtime"] == stat.st_mtime:
+                if route and known["route"] != route:
+                    with self._lock:
+                        known["route"] = route
+                    changed += 1
+                continue
+
+            try:
+                mid = mido.MidiFile(path)
+            except (OSError, ValueError, EOFError, KeyError) as e:
+                print(f"Skipping {title}: {e}")
+                continue
+            notes = mid_to_notes(mid, override_time_info=True)
+            if notes is None:
+                continue
+
+            self._put(self._row(title, route, known, notes, stat.st_size, stat.st_mtime))
+            changed += 1
+        return changed
+
+    def _row(self, title: str, route: str, known: dict, notes, size: int, mtime: float) -> dict:
+        return {
+            "title": title,
+            "route": route or (known["route"] if known is not None else None),
+            "key": estimate_key(notes["pitch"], notes["duration"]),
+            "notes": len(notes),
+            "duration": float((notes["onset"] + notes["duration"]).max()) if len(notes) > 0 else 0.0,
+            "size": size,
+            "mtime": mtime,
+        }
+
+    def _put(self, song: dict) -> None:
+        with self._lock:
+            if song["title"] in self.songs:
+                self._unindex_song(song["title"])
+            self._index_song(song)
+
+    def _words(self, song: dict) -> dict:
+        words = {word: 1.0 for word in tokenize(song["title"])}
+        for word in tokenize(song["key"] or ""):
+            words.setdefault(word, self.metadata_weight)
+        return words
+
+    def _index_song(self, song: dict) -> None:
+        self.songs[song["title"]] = song
+        for word, weight in self._words(song).items():
+            if word not in self._postings:
+                self._postings[word] = {}
+                for gram in trigrams(word):
+                    self._grams.setdefault(gram, set()).add(word)
+            self._postings[word][song["title"]] = weight
+
+    def _unindex_song(self, title: str) -> None:
+        song = self.songs.pop(title)
+        for word in self._words(song):
+            postings = self._postings[word]
+            postings.pop(title, None)
+            if not postings:
+                del self._postings[word]
+                for gram in trigrams(word):
+                    self._grams[gram].discard(word)
+                    if not self._grams[gram]:
+                        del self._grams[gram]
+
+    def _save(self) -> None:
+        if self.path is None:
+            return
+        with self._lock:
+            songs = list(self.songs.values())
+        write_atomically(self.path, json.dumps(songs).encode())
+
+
+if __name__ == "__main__":
+
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Index the downloaded songs, or search the index.")
+    parser.add_argument("query", nargs="?", help="Words to search for; without them, the index is built.")
+    parser.add_argument("-d", "--directory", default="../assets/midi/downloads", help="Directory with the midi files.")
+    parser.add_argument("-o", "--output", default="../assets/cache/song_index.json", help="Where the index is saved.")
+
+    args = parser.parse_args()
+
+    index = SongIndex(args.output)
+    if args.query is None:
+        print("Added or updated", index.build(args.directory), "songs;", len(index), "songs in the index.")
+    else:
+        for hit in index.search(args.query):
+            print(f"{hit['score']:.2f}  {hit['title']}  ({hit['key']}, {hit['notes']} notes)")
@@ -0,0 +1,163 @@
+"""
+In-process store of the lesson state shared by the server's routes.
+
+The state (what the app is doing, the last feedback, the last mistake made
+while playing and the song) lives in memory, so reading it costs nothing and
+never touches the disk. Every change
+happens under one lock and bumps a version counter; compare_and_set only
+applies a change if the state still is what the caller expects, so two
+requests can no longer overwrite each other's updates. wait blocks until
+the version moves on, so changes can be pushed to clients as they happen.
+
+Changes are written to state.json behind the requests' backs: a background
+thread saves the latest state a moment after it changes, once per burst of
+changes, replacing the file at once so it is never read half-written.
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+
+from libs.pymidifile import write_atomically
+
+
+class StateStore:
+
+    defaults = {"state": "search", "feedback": "", "live_mistake": "", "song": ""}
+
+    def __init__(self, path: str = "state.json", flush_delay: float = 0.2) -> None:
+        """
+        Args:
+            path (str): File the state is loaded from and saved to, None to keep it in memory only
+            flush_delay (float): Seconds to wait after a change before saving, so a burst of changes is saved once
+
+        Returns:
+            None
+        """
+        self.path = path
+        self.flush_delay = flush_delay
+        self.version = 0
+
+        self._state = dict(self.defaults)
+        self._changed = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._saved_version = 0
+
+        if self.path is None:
+            return
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self._state.update(json.load(f))
+            except (OSError, ValueError):
+                # unreadable, start from the defaults
+                pass
+        else:
+            self._write(dict(self._state))
+
+        threading.Thread(target=self._write_behind, daemon=True).start()
+        atexit.register(self.flush)
+
+    def get(self, key: str):
+        """
+        Args:
+            key (str): Name of a field of the state ("state", "feedback", "live_mistake" or "song")
+
+        Returns:
+            The field's current value
+        """
+        with self._changed:
+            return self._state[key]
+
+    def snapshot(self) -> tuple:
+        """
+        Returns:
+            tuple: (version, copy of the whole state)
+        """
+        with self._changed:
+            return self.version, dict(self._state)
+
+    def wait(self, version: int, timeout: float = None) -> tuple:
+        """
+        Wait until the state is no longer at the given version (it has changed since).
+
+        Args:
+            version (int): The version the caller has seen
+            timeout (float): Seconds to wait at most, None to wait for as long as it takes
+
+        Returns:
+            tuple: (version, copy of the whole state), unchanged if the timeout passed first
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout)
+            return self.version, dict(self._state)
+
+    def set(self, **changes) -> int:
+        """
+        Change fields of the state.
+
+        Args:
+            changes: New values, by field name
+
+        Returns:
+            int: The version of the state after the change
+        """
+        with self._changed:
+            return self._apply(changes)
+
+    def compare_and_set(self, expected: dict, **changes) -> bool:
+        """
+        Change fields of the state, but only if other fields still have the expected values.
+
+        Args:
+            expected (dict): Values the state must have, by field name
+            changes: New values, by field name
+
+        Returns:
+            bool: Whether the change was made
+        """
+        with self._changed:
+            if any(self._state.get(key) != value for key, value in expected.items()):
+                return False
+            self._apply(changes)
+            return True
+
+    def flush(self) -> None:
+        """
+        Save the state now if it has changed since it was last saved.
+
+        Returns:
+            None
+        """
+        if self.path is None:
+            return
+        with self._write_lock:
+            version, state = self.snapshot()
+            if version <= self._saved_version:
+                return
+            self._write(state)
+            self._saved_version = version
+
+    def _apply(self, changes: dict) -> int:
+        # the caller holds the lock
+        self._state.update(changes)
+        self.version += 1
+        self._changed.notify_all()
+        return self.version
+
+    def _write_behind(self) -> None:
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: self.version > self._saved_version)
+            time.sleep(self.flush_delay)
+            try:
+                self.flush()
+            except OSError as e:
+                # tried again after the next delay
+                print(f"Could not save the state to {self.path}: {e}")
+
+    def _write(self, state: dict) -> None:
+        write_atomically(self.path, json.dumps(state).encode())
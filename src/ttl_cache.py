@@ -0,0 +1,65 @@
+"""
+A small in-memory cache whose entries expire, shared by the feedback service
+(rephrased advice) and the song search (search results).
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    A least-recently-used cache whose entries also expire after `ttl` seconds.
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 24 * 3600) -> None:
+        """
+        Args:
+            maxsize (int): Number of entries kept at most
+            ttl (float): Seconds an entry is kept for
+
+        Returns:
+            None
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Args:
+            key: The entry's key
+
+        Returns:
+            The entry's value, None if there is none or it has expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value) -> None:
+        """
+        Args:
+            key: The entry's key
+            value: The entry's value
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC)
+
+
+@pytest.fixture(autouse=True)
+def in_src(monkeypatch):
+    # the modules find the assets relative to src, as when they are run from there
+    monkeypatch.chdir(SRC)
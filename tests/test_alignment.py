@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from alignment import band_limits, edit_distance_table, trace_alignment
+from analyzer import Analyzer
+
+REFERENCE = "../assets/midi/twinkle-twinkle-little-star.mid"
+WRONG_PITCHES = "../assets/midi/twinkle-twinkle-wrong-pitches.mid"
+MISSING_NOTES = "../assets/midi/twinkle-twinkle-missing-notes.mid"
+
+
+def traced(user_file):
+    analyzer = Analyzer()
+    ref_pitches, ref_times = analyzer.note_times(analyzer.note_array(REFERENCE))
+    user_pitches, user_times = analyzer.note_times(analyzer.note_array(user_file))
+    dp = edit_distance_table(ref_pitches, user_pitches)
+    return trace_alignment(dp, ref_pitches, user_pitches, ref_times, user_times)
+
+
+def test_trace_alignment_times_wrong_pitches():
+    timing_issues, incorrect_pitches = traced(WRONG_PITCHES)
+
+    assert timing_issues == []
+    # each wrong note is a missing reference note and an extra user note, at the note's own onset
+    assert [(e["reference_pitch"], e["user_pitch"], e["time"]) for e in incorrect_pitches] == [
+        (67, None, 1615), (None, 68, 1615),
+        (67, None, 1520), (None, 68, 1520),
+        (60, None, 1520), (None, 61, 1520),
+        (48, None, 1520), (None, 49, 1520),
+        (48, None, 568), (None, 49, 568),
+    ]
+
+
+def test_trace_alignment_times_missing_notes():
+    timing_issues, incorrect_pitches = traced(MISSING_NOTES)
+
+    assert timing_issues == [{"reference_pitch": 67, "reference_time": 1615, "time": 1520}]
+    assert [(e["reference_pitch"], e["user_pitch"], e["time"]) for e in incorrect_pitches] == [
+        (67, None, 3606), (60, None, 3606), (48, None, 3606), (67, None, 1520),
+    ]
+
+
+@pytest.mark.parametrize("band", [None, 8])
+def test_classified_wrong_pitch_times(band):
+    errors = Analyzer(alignment_band=band).midi_compare(REFERENCE, WRONG_PITCHES)
+
+    assert errors["incorrect_pitches"] == [
+        {"reference_pitch": 67, "user_pitch": 68, "time": 1615},
+        {"reference_pitch": 67, "user_pitch": 68, "time": 1520},
+        {"reference_pitch": 60, "user_pitch": 61, "time": 1520},
+        {"reference_pitch": 48, "user_pitch": 49, "time": 1520},
+        {"reference_pitch": 48, "user_pitch": 49, "time": 568},
+    ]
+    assert errors["timing_issues"] == errors["missing_notes"] == errors["extra_notes"] == []
+
+
+def cell_by_cell(ref, user, lo=None, hi=None):
+    # the textbook recurrence, over the cells of each row between lo[i] and hi[i]
+    n, m = len(ref), len(user)
+    dp = np.full((n + 1, m + 1), np.inf)
+    for i in range(n + 1):
+        for j in range(m + 1):
+            if lo is not None and not lo[i] <= j <= hi[i]:
+                continue
+            if i == 0 or j == 0:
+                dp[i, j] = i + j
+                continue
+            dp[i, j] = min(dp[i - 1, j - 1] + (ref[i - 1] != user[j - 1]), dp[i - 1, j] + 1, dp[i, j - 1] + 1)
+    return dp
+
+
+@pytest.mark.parametrize("band", [None, 1, 3, 8])
+def test_edit_distance_table_matches_the_recurrence(band):
+    rng = np.random.default_rng(band or 0)
+    for _ in range(40):
+        n, m = rng.integers(1, 30, 2)
+        ref, user = rng.integers(60, 64, n), rng.integers(60, 64, m)
+        times = (np.sort(rng.random(n)), np.sort(rng.random(m))) if rng.random() < 0.5 else (None, None)
+        limits = band_limits(n, m, band, *times) if band is not None else (None, None)
+        assert np.array_equal(edit_distance_table(ref, user, band, *times), cell_by_cell(ref, user, *limits))
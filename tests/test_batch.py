@@ -0,0 +1,34 @@
+import shutil
+
+import pytest
+
+from libs.pymidifile.batch import batch_process
+
+FIXTURES = [
+    "../assets/midi/twinkle-twinkle-little-star.mid",
+    "../assets/midi/twinkle-twinkle-wrong-pitches.mid",
+]
+
+
+def statuses(records):
+    return sorted(record["status"] for record in records)
+
+
+@pytest.mark.parametrize("in_place", [True, False])
+def test_files_are_processed_again_when_the_options_change(tmp_path, in_place):
+    library = tmp_path / "library"
+    library.mkdir()
+    for fixture in FIXTURES:
+        shutil.copy(fixture, library)
+    output = None if in_place else str(tmp_path / "output")
+
+    def run(**options):
+        return statuses(batch_process(str(library), output, processes=1, verbose=False, **options))
+
+    # reformat_midi.py <dir>, then quantize.py <dir>
+    assert run(quantize=False) == ["done", "done"]
+    assert run(quantize=True) == ["done", "done"]
+    assert run(quantize=True) == ["skipped", "skipped"]
+    assert run(quantize=True, stepSize=0.5) == ["done", "done"]
+    assert run(quantize=True, stepSize=0.5, quantizeDurations=True) == ["done", "done"]
+    assert run(quantize=True, stepSize=0.5, quantizeDurations=True) == ["skipped", "skipped"]
@@ -0,0 +1,74 @@
+import os
+import shutil
+import threading
+
+import mido
+import numpy as np
+
+from corpus import CorpusStore
+from libs.pymidifile import mid_to_notes
+
+SONGS = [
+    "../assets/midi/twinkle-twinkle-little-star.mid",
+    "../assets/midi/downloads/Twinkle-Twinkle.mid",
+    "../assets/midi/downloads/chromatic.mid",
+    "../assets/midi/downloads/twinkle.mid",
+]
+
+
+def test_songs_added_at_once_get_their_own_notes(tmp_path):
+    # as when the server handles several /setSong requests at the same time
+    paths = []
+    for i in range(4):
+        for song in SONGS:
+            path = str(tmp_path / f"{i}-{os.path.basename(song)}")
+            shutil.copy(song, path)
+            paths.append(path)
+
+    corpus = CorpusStore(str(tmp_path / "corpus"))
+    barrier = threading.Barrier(len(paths))
+
+    def add(path):
+        barrier.wait()
+        corpus.add(path)
+
+    threads = [threading.Thread(target=add, args=(path,)) for path in paths]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # every song's notes are where its row says, in the store and in the sidecar read back
+    spans = sorted((song["offset"], song["offset"] + song["notes"]) for song in corpus.songs.values())
+    assert all(end <= start for (_, end), (start, _) in zip(spans, spans[1:]))
+    reloaded = CorpusStore(str(tmp_path / "corpus"))
+    assert len(reloaded) == len(paths)
+    for path in paths:
+        expected = mid_to_notes(mido.MidiFile(path), override_time_info=True).sorted().notes
+        assert np.array_equal(reloaded.notes(os.path.basename(path)).notes, expected)
+
+
+def test_song_index_is_built_from_the_corpus(tmp_path, monkeypatch):
+    import song_index
+    from song_index import SongIndex
+
+    downloads = tmp_path / "downloads"
+    downloads.mkdir()
+    for song in SONGS:
+        shutil.copy(song, downloads)
+    corpus = CorpusStore(str(tmp_path / "corpus"))
+    corpus.build(str(downloads))
+    parsed = SongIndex(path=None)
+    parsed.build(str(downloads))
+
+    # the same rows as parsing the files, without parsing them
+    monkeypatch.setattr(song_index.mido, "MidiFile", None)
+    index = SongIndex(path=str(tmp_path / "song_index.json"))
+    assert index.build_from_corpus(corpus) == len(SONGS)
+    assert index.songs == parsed.songs
+    assert [hit["title"] for hit in index.search("twinkle little star")] == [
+        hit["title"] for hit in parsed.search("twinkle little star")
+    ]
+
+    # unchanged songs are skipped on the next start
+    assert SongIndex(path=str(tmp_path / "song_index.json")).build_from_corpus(corpus) == 0
@@ -0,0 +1,72 @@
+import time
+
+from feedback import FeedbackService, StubClient, rule_based_feedback
+from state_store import StateStore
+
+ADVICE = "Time 1000: A custom message the phrasing table does not have."
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_late_rephrasing_does_not_override_a_newer_state():
+    store = StateStore(path=None)
+    store.set(state="recording")
+    client = StubClient(delay=0.5)
+    service = FeedbackService(client, store, deadline=3.0)
+
+    service.submit(ADVICE)
+    # the lesson moves on before the model answers
+    store.set(state="demoing")
+
+    assert wait_for(lambda: client.calls == 1)
+    time.sleep(0.7)
+    assert store.get("state") == "demoing"
+    assert store.get("feedback") == ""
+
+
+def test_late_fallback_does_not_override_a_newer_state():
+    store = StateStore(path=None)
+    store.set(state="recording")
+    service = FeedbackService(StubClient(delay=0.5), store, deadline=0.2)
+
+    service.submit(ADVICE)
+    store.set(state="demoing")
+
+    time.sleep(0.8)
+    assert store.get("state") == "demoing"
+
+
+def test_fallback_is_published_when_the_model_is_slow():
+    store = StateStore(path=None)
+    store.set(state="recording")
+    service = FeedbackService(StubClient(delay=0.5), store, deadline=0.1)
+
+    service.submit(ADVICE)
+
+    assert wait_for(lambda: store.get("state") == "feedback")
+    assert store.get("feedback") == rule_based_feedback(ADVICE)
+    # the model's answer comes in after the fallback and is dropped
+    time.sleep(0.6)
+    assert store.get("feedback") == rule_based_feedback(ADVICE)
+
+
+def test_rephrasing_is_published_and_cached():
+    store = StateStore(path=None)
+    store.set(state="recording")
+    client = StubClient(delay=0.05)
+    service = FeedbackService(client, store)
+
+    service.submit(ADVICE)
+    assert wait_for(lambda: store.get("state") == "feedback")
+    first = store.get("feedback")
+
+    store.set(state="recording")
+    service.submit(ADVICE)
+    assert store.get("state") == "feedback"
+    assert store.get("feedback") == first
+    assert client.calls == 1
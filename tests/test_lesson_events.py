@@ -0,0 +1,135 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from feedback import FeedbackService, StubClient
+from lesson_events import BackgroundEvents, HttpEvents, LessonEvents, StoreEvents
+from state_store import StateStore
+
+ADVICE = "Time 1000: A custom message the phrasing table does not have."
+
+
+@pytest.fixture
+def server():
+    """The lesson routes of the Flask server, on a state store with a slow feedback model."""
+    store = StateStore(path=None)
+    service = FeedbackService(StubClient(delay=0.2), store)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {key: values[0] for key, values in parse_qs(url.query, keep_blank_values=True).items()}
+            if url.path == "/setState":
+                store.set(state=params["state"])
+                body = {"message": "State set."}
+            elif url.path == "/setFeedback":
+                service.submit(params["feedback"])
+                body = {"message": "Feedback set."}
+            elif url.path == "/setLiveMistake":
+                store.set(live_mistake=params.get("mistake", ""))
+                body = {"message": "Live mistake set."}
+            else:
+                version, state = store.wait(int(params["since"]), float(params["timeout"]))
+                body = dict(state, version=version)
+            body = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_port}", store
+    httpd.shutdown()
+
+
+def store_events():
+    store = StateStore(path=None)
+    return StoreEvents(store, FeedbackService(StubClient(delay=0.2), store)), store
+
+
+@pytest.mark.parametrize("background", [False, True])
+def test_store_events_wait_for_rephrased_feedback(background):
+    events, store = store_events()
+    if background:
+        events = BackgroundEvents(events)
+
+    events.set_state("recording")
+    events.set_feedback(ADVICE)
+
+    assert events.wait_for_feedback(2)
+    assert store.get("state") == "feedback"
+    assert store.get("feedback").endswith(ADVICE)
+
+
+@pytest.mark.parametrize("background", [False, True])
+def test_http_events_wait_for_rephrased_feedback(server, background):
+    base_url, store = server
+    events = HttpEvents(base_url)
+    if background:
+        events = BackgroundEvents(events)
+
+    events.set_state("recording")
+    events.set_feedback(ADVICE)
+
+    start = time.monotonic()
+    assert events.wait_for_feedback(2)
+    assert time.monotonic() - start < 1
+    assert store.get("feedback").endswith(ADVICE)
+
+
+def test_wait_for_feedback_times_out():
+    events, store = store_events()
+    events.set_state("recording")
+
+    start = time.monotonic()
+    assert not events.wait_for_feedback(0.2)
+    assert time.monotonic() - start == pytest.approx(0.2, abs=0.1)
+
+
+def test_http_wait_for_feedback_times_out(server):
+    base_url, _ = server
+    events = HttpEvents(base_url)
+    events.set_state("recording")
+
+    assert not events.wait_for_feedback(0.2)
+
+
+@pytest.mark.parametrize("transport", ["store", "http"])
+def test_live_mistakes_reach_the_state(server, transport):
+    if transport == "store":
+        events, store = store_events()
+    else:
+        base_url, store = server
+        events = HttpEvents(base_url)
+    events = BackgroundEvents(events)
+
+    events.set_state("recording")
+    events.set_live_mistake("Time 480: You missed a note here. Try playing it again.")
+    events.flush()
+    assert store.get("state") == "recording"
+    assert store.get("live_mistake") == "Time 480: You missed a note here. Try playing it again."
+
+    # cleared when the next attempt starts
+    events.set_live_mistake("")
+    events.flush()
+    assert store.get("live_mistake") == ""
+
+
+def test_transports_without_every_method_cannot_be_made():
+    class StateOnly(LessonEvents):
+        def set_state(self, state):
+            pass
+
+    with pytest.raises(TypeError):
+        StateOnly()
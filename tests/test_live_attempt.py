@@ -0,0 +1,71 @@
+import mido
+import pytest
+
+from analyzer import Analyzer
+from snippets import SongSnippets
+
+REFERENCE = "../assets/midi/twinkle-twinkle-little-star.mid"
+ATTEMPTS = [
+    "../assets/midi/twinkle-twinkle-little-star.mid",
+    "../assets/midi/twinkle-twinkle-wrong-pitches.mid",
+    "../assets/midi/twinkle-twinkle-missing-note.mid",
+    "../assets/midi/twinkle-twinkle-missing-notes.mid",
+    "../assets/midi/twinkle-twinkle-bad.mid",
+]
+
+
+def note_events(mid, resolution, lead_in=0):
+    """(tick, is_on, pitch) of every note of a file, in `resolution` ticks per beat."""
+    events = []
+    ticks = 0
+    for msg in mido.merge_tracks(mid.tracks):
+        ticks += msg.time
+        if msg.type in ("note_on", "note_off"):
+            tick = round(ticks * resolution / mid.ticks_per_beat) + lead_in
+            events.append((tick, msg.type == "note_on" and msg.velocity > 0, msg.note))
+    return events
+
+
+def replay(analyzer, reference, events, verified_notes=0):
+    """Feed the events to a live attempt, as Player.record_attempt does, and record them like it."""
+    live = analyzer.start_attempt(reference, verified_notes=verified_notes)
+    track = mido.MidiTrack()
+    previous = 0
+    for tick, is_on, pitch in events:
+        delta, previous = tick - previous, tick
+        if is_on:
+            live.note_on(pitch, delta)
+            track.append(mido.Message("note_on", note=pitch, velocity=64, time=delta))
+        else:
+            live.note_off(pitch, delta)
+            track.append(mido.Message("note_off", note=pitch, velocity=0, time=delta))
+    recording = mido.MidiFile(ticks_per_beat=reference.ticks_per_beat)
+    recording.tracks.append(track)
+    return live.verdict(), recording
+
+
+@pytest.mark.parametrize("attempt", ATTEMPTS)
+@pytest.mark.parametrize("lead_in", [0, 480])
+def test_live_verdict_matches_judge_attempt(attempt, lead_in):
+    analyzer = Analyzer()
+    reference = mido.MidiFile(REFERENCE)
+    events = note_events(mido.MidiFile(attempt), reference.ticks_per_beat, lead_in)
+
+    verdict, recording = replay(analyzer, reference, events)
+
+    assert verdict == analyzer.judge_attempt(reference, recording)
+
+
+@pytest.mark.parametrize("lead_in", [0, 480])
+def test_live_verdict_matches_judge_attempt_on_snippets(lead_in):
+    analyzer = Analyzer()
+    snippets = SongSnippets.from_midi(mido.MidiFile(REFERENCE))
+    for snippet in snippets:
+        reference = snippet.to_midi()
+        # every note a semitone sharp, so the wrong pitches must be found after the lead-in
+        events = [(tick, is_on, pitch + 1) for tick, is_on, pitch in note_events(reference, reference.ticks_per_beat, lead_in)]
+
+        verdict, recording = replay(analyzer, reference, events, snippet.verified_notes)
+
+        assert verdict == analyzer.judge_attempt(reference, recording, snippet.verified_notes)
+        assert verdict[0] is False
@@ -0,0 +1,98 @@
+import os
+import shutil
+
+import mido
+import pytest
+
+import song_cache
+from analyzer import Analyzer
+from song_cache import SongCache
+
+SONG = "../assets/midi/twinkle-twinkle-little-star.mid"
+
+
+def test_unchanged_files_are_hashed_once(tmp_path, monkeypatch):
+    path = str(tmp_path / "song.mid")
+    shutil.copy(SONG, path)
+    cache = SongCache(str(tmp_path / "cache"))
+
+    hashed = []
+    sha1 = song_cache.hashlib.sha1
+    monkeypatch.setattr(song_cache.hashlib, "sha1", lambda data: hashed.append(path) or sha1(data))
+
+    key = cache.key(path)
+    cache.song_snippets(path)
+    cache.quantized_notes(path, Analyzer().quantize_grid())
+    assert cache.key(path) == key
+    assert len(hashed) == 1
+
+    # an edited file gets a new key
+    mid = mido.MidiFile(path)
+    mid.tracks[0].append(mido.MetaMessage("text", text="edited"))
+    mid.save(path)
+    os.utime(path, ns=(0, 0))
+    assert cache.key(path) != key
+    assert len(hashed) == 2
+
+
+# notes off the grid: a slice of the quantized song is up to 27 ticks away from the quantized snippet
+OFF_GRID_SONG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "bitmidi", "Twinkle-Twinkle.mid")
+
+
+@pytest.mark.parametrize("song", [SONG, OFF_GRID_SONG])
+def test_live_attempt_on_cached_reference(tmp_path, song):
+    analyzer = Analyzer()
+    cache = SongCache(str(tmp_path))
+    snippets = cache.song_snippets(song)
+    reference_notes = cache.quantized_snippets(song, analyzer.quantize_grid())
+    assert len(reference_notes) == len(snippets)
+
+    # read back from disk, by another cache
+    assert [len(notes) for notes in SongCache(str(tmp_path)).quantized_snippets(song, analyzer.quantize_grid())] == [
+        len(notes) for notes in reference_notes
+    ]
+
+    for snippet, notes in zip(snippets, reference_notes):
+        reference = snippet.to_midi()
+        cached = analyzer.start_attempt(reference, reference_notes=notes)
+        parsed = analyzer.start_attempt(reference)
+        assert cached.ref_pitches == parsed.ref_pitches
+        assert cached.ref_times == parsed.ref_times
+
+        # the student plays the snippet as written, then a semitone sharp
+        for shift, sufficient in ((0, True), (1, False)):
+            attempt = analyzer.start_attempt(reference, reference_notes=notes)
+            for msg in reference.tracks[0]:
+                if msg.type == "note_on":
+                    attempt.note_on(msg.note + shift, msg.time)
+                elif msg.type == "note_off":
+                    attempt.note_off(msg.note + shift, msg.time)
+            assert attempt.verdict()[0] is sufficient
+
+
+def test_entries_are_kept_in_memory(tmp_path, monkeypatch):
+    grid = Analyzer().quantize_grid()
+    cache = SongCache(str(tmp_path))
+    stored = []
+    store = cache.store
+    monkeypatch.setattr(cache, "store", lambda key, arrays: stored.append(key) or store(key, arrays))
+
+    # a lesson on a new song: preprocessed once, its snippets quantized once
+    cache.song_snippets(SONG)
+    cache.quantized_snippets(SONG, grid)
+    assert cache.stats() == {"hits": 0, "misses": 1}
+    assert len(stored) == 2
+
+    # the next lesson on it neither reads nor writes the disk
+    cache.song_snippets(SONG)
+    cache.quantized_snippets(SONG, grid)
+    assert cache.stats() == {"hits": 0, "misses": 1}
+    assert len(stored) == 2
+
+    # another cache reads the entry once, with the quantized snippets in it
+    other = SongCache(str(tmp_path))
+    monkeypatch.setattr(other, "store", lambda key, arrays: stored.append(key))
+    other.song_snippets(SONG)
+    other.quantized_snippets(SONG, grid)
+    assert other.stats() == {"hits": 1, "misses": 0}
+    assert len(stored) == 2
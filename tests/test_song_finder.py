@@ -0,0 +1,180 @@
+import os
+import shutil
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import pytest
+
+from song_finder import SearchService, SongFinder, TokenBucket
+from song_index import SongIndex
+
+PAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "bitmidi")
+SONG = "../assets/midi/twinkle-twinkle-little-star.mid"
+
+
+@pytest.fixture
+def site():
+    """A local stand-in for the song site, serving its pages; it answers every request after `delay` seconds."""
+
+    class Site:
+        delay = 0.0
+        failing = False
+        requests = []
+
+    with open(os.path.join(PAGES, "search.html"), "rb") as f:
+        search_page = f.read()
+    with open(os.path.join(PAGES, "song.html"), "rb") as f:
+        song_page = f.read()
+    with open(SONG, "rb") as f:
+        song = f.read()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            Site.requests.append((time.monotonic(), self.path))
+            time.sleep(Site.delay)
+            route = urlparse(self.path).path
+            status = 200
+            if Site.failing:
+                status, body = 500, b"Internal Server Error"
+            elif route == "/search":
+                body = search_page
+            elif route == "/twinkle-twinkle-little-star-mid":
+                body = song_page
+            elif route == "/uploads/108573.mid":
+                body = song
+            else:
+                status, body = 404, b"Not Found"
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    Site.url = f"http://127.0.0.1:{server.server_port}"
+    yield Site
+    server.shutdown()
+
+
+def search_requests(site):
+    return [path for _, path in site.requests if path.startswith("/search")]
+
+
+def test_search_results_are_parsed(site):
+    service = SearchService(site.url, cache_dir=None)
+
+    assert service.search("twinkle") == [
+        ("twinkle-twinkle-little-star.mid", "/twinkle-twinkle-little-star-mid"),
+        ("Twinkle-Twinkle.mid", "/twinkle-twinkle-mid"),
+        ("twinkle.mid", "/twinkle-mid"),
+    ]
+
+
+def test_identical_searches_in_flight_are_coalesced(site):
+    site.delay = 0.2
+    service = SearchService(site.url, cache_dir=None)
+
+    results = []
+    searches = [
+        threading.Thread(target=lambda query=query: results.append(service.search(query)))
+        for query in ["twinkle star", "Twinkle  Star", "TWINKLE STAR "] * 3
+    ]
+    for search in searches:
+        search.start()
+    for search in searches:
+        search.join()
+
+    assert search_requests(site) == ["/search?q=twinkle+star"]
+    assert len(results) == 9 and all(result == results[0] for result in results)
+
+
+def test_requests_are_rate_limited(site):
+    service = SearchService(site.url, cache_dir=None, rate=10, burst=2)
+
+    for i in range(6):
+        service.search(f"song {i}")
+
+    times = [t for t, _ in site.requests]
+    assert len(times) == 6
+    # the burst goes out at once, then one request every 1 / rate seconds
+    assert times[1] - times[0] < 0.05
+    gaps = [b - a for a, b in zip(times[1:], times[2:])]
+    assert min(gaps) >= 0.08
+    assert times[-1] - times[0] >= 0.35
+
+
+def test_token_bucket_waits_for_tokens():
+    bucket = TokenBucket(rate=20, capacity=1)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == pytest.approx(0.05, abs=0.01)
+
+
+def test_results_are_cached_on_disk_until_they_expire(site, tmp_path):
+    cache_dir = str(tmp_path)
+    SearchService(site.url, cache_dir=cache_dir, ttl=0.5).search("twinkle")
+    assert len(search_requests(site)) == 1
+
+    # a new process finds the results on disk
+    fresh = SearchService(site.url, cache_dir=cache_dir, ttl=0.5)
+    assert fresh.cached("twinkle") is not None
+    fresh.search("twinkle")
+    assert len(search_requests(site)) == 1
+
+    time.sleep(0.6)
+    assert SearchService(site.url, cache_dir=cache_dir, ttl=0.5).cached("twinkle") is None
+    # in memory they expire too
+    assert fresh.cached("twinkle") is None
+    fresh.search("twinkle")
+    assert len(search_requests(site)) == 2
+
+
+def test_failed_searches_are_not_cached(site, tmp_path):
+    service = SearchService(site.url, cache_dir=str(tmp_path))
+
+    site.failing = True
+    assert service.search("twinkle") == []
+    site.failing = False
+    assert len(service.search("twinkle")) == 3
+    assert len(search_requests(site)) == 2
+
+
+def test_downloaded_songs_are_indexed(site, tmp_path, monkeypatch):
+    monkeypatch.setattr(SongFinder, "downloads_dir", str(tmp_path))
+    index = SongIndex(path=None)
+    finder = SongFinder(SearchService(site.url, cache_dir=None), index)
+
+    mid = finder._download_midi("/twinkle-twinkle-little-star-mid")
+
+    assert len(mid.tracks) > 0
+    assert os.path.isfile(tmp_path / "twinkle-twinkle-little-star.mid")
+    hits = index.search("twinkle little star")
+    assert [(hit["title"], hit["route"]) for hit in hits] == [
+        ("twinkle-twinkle-little-star.mid", "/twinkle-twinkle-little-star-mid")
+    ]
+
+
+def test_downloaded_songs_are_not_listed_twice(site, tmp_path, monkeypatch):
+    import song_finder
+
+    # Twinkle-Twinkle.mid is on disk, but was not downloaded through the site, so it has no route
+    shutil.copy("../assets/midi/downloads/Twinkle-Twinkle.mid", tmp_path / "Twinkle-Twinkle.mid")
+    index = SongIndex(path=None)
+    index.build(str(tmp_path))
+    monkeypatch.setattr(song_finder, "song_index", index)
+    monkeypatch.setattr(song_finder, "search_service", SearchService(site.url, cache_dir=None))
+
+    results, complete = song_finder.find_songs("twinkle", wait=True)
+
+    assert complete
+    titles = [title for title, _ in results]
+    assert titles[0] == "Twinkle-Twinkle.mid"
+    assert [song_finder.song_key(title) for title in titles].count("twinkle twinkle") == 1
+    assert "twinkle-twinkle-little-star.mid" in titles